@@ -0,0 +1,124 @@
+#!/usr/bin/python
+"""
+Benchmark MediaFactory.retrieve_all against a local HTTP stand-in of the
+twitter image server, sequential vs concurrent download.
+
+    PYTHONPATH=. python bench/download_pipeline.py [images] [latency_ms]
+"""
+
+import atexit
+import BaseHTTPServer
+import ConfigParser
+import shutil
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from download_twitter.daily import DailyLinker
+from download_twitter.dedup import Deduplicator
+from download_twitter.image import MediaFactory
+from download_twitter.links import LinkResolver
+from download_twitter.mediaindex import MediaIndex
+
+
+# smallest jpeg structure pexif accepts: SOI, APP0 (JFIF), SOS, data, EOI
+PAYLOAD = ''.join([
+    '\xff\xd8',
+    '\xff\xe0', struct.pack('>H', 16), 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00',
+    '\xff\xda', struct.pack('>H', 8), '\x01\x01\x00\x00\x3f\x00',
+    'x' * 64 * 1024,
+    '\xff\xd9',
+])
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def handler(latency):
+    class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+
+        def log_message(self, *args):
+            pass
+    return SlowHandler
+
+
+class FakeAPI(object):
+    """ Stand-in for `Twitter`, fetch images with urllib2 """
+    listcontent = {'list_content': {'Person': []}}
+
+    @staticmethod
+    def get_image(url):
+        return urllib2.urlopen(url).read()
+
+
+def statuses(base_url, count):
+    return [{
+        'id': status_id,
+        'text': 'status %d' % status_id,
+        'created_at': 'Mon Jan 01 00:00:00 +0000 2018',
+        'user': {'screen_name': 'bench', 'name': 'bench'},
+        'entities': {'media': [{
+            'id_str': str(status_id),
+            'media_url': '%s/%d.jpg' % (base_url, status_id),
+        }]},
+    } for status_id in range(count, 0, -1)]
+
+
+def run(base_url, count, concurrency):
+    directory = tempfile.mkdtemp()
+    # after the stores are written back at exit
+    atexit.register(shutil.rmtree, directory, True)
+    config = ConfigParser.ConfigParser()
+    config.add_section('path')
+    config.set('path', 'image_path', directory)
+    config.set('path', 'daily_path', directory + '/daily')
+    config.set('path', 'data_dir', directory)
+    config.add_section('download')
+    config.set('download', 'concurrency', str(concurrency))
+
+    api = FakeAPI()
+    api.resolver = LinkResolver(config)
+    api.dedup = Deduplicator(config)
+    api.media_index = MediaIndex(config)
+    api.daily = DailyLinker(config)
+    factory = MediaFactory(api, config, 'Person', 'bench')
+    start = time.time()
+    result = factory.retrieve_all(statuses(base_url, count))
+    api.daily.flush()
+    return time.time() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+
+    server = ThreadedServer(('127.0.0.1', 0), handler(latency))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    reference = None
+    for concurrency in (1, 2, 4, 8, 16):
+        elapsed, result = run(base_url, count, concurrency)
+        reference = reference or result
+        assert result == reference, (result, reference)
+        print "concurrency %2d: %6.2fs for %d images %s" % (
+                concurrency, elapsed, count, result)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+Micro benchmark of the exif writing in Image.write: pexif parse and
+re-serialize against the exif segment insertion (or update, for a jpeg
+which already has exif).
+
+    PYTHONPATH=. python bench/exif_write.py [size_kb] [loops]
+"""
+
+import os
+import struct
+import sys
+import time
+
+import pexif
+
+from download_twitter import exif
+
+
+def jpeg(size):
+    """ SOI, APP0 (JFIF), SOS, `size` bytes of image data, EOI """
+    return ''.join([
+        exif.SOI,
+        '\xff\xe0', struct.pack('>H', 16),
+        'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00',
+        '\xff\xda', struct.pack('>H', 8), '\x01\x01\x00\x00\x3f\x00',
+        os.urandom(size).replace('\xff', '\x00'),
+        '\xff\xd9',
+    ])
+
+
+TAGS = {
+    exif.IMAGE_DESCRIPTION: 'a status text http://t.co/abcdefghij',
+    exif.ARTIST: 'Some Friend',
+    exif.DATE_TIME: 'Mon Jan 01 00:00:00 +0000 2018',
+}
+
+
+def with_pexif(data, fdesc):
+    img = pexif.JpegFile.fromString(data)
+    img.exif.primary.ImageDescription = TAGS[exif.IMAGE_DESCRIPTION]
+    img.exif.primary.Artist = TAGS[exif.ARTIST]
+    img.exif.primary.DateTime = TAGS[exif.DATE_TIME]
+    fdesc.write(img.writeString())
+
+
+def with_segment(data, fdesc):
+    exif.write_with_exif(fdesc, data, TAGS,
+                         keep=(exif.ARTIST, exif.DATE_TIME))
+
+
+def with_camera_exif(data):
+    """ data with the exif of a camera (description, artist, sub IFD) """
+    img = pexif.JpegFile.fromString(data)
+    img.exif.primary.ImageDescription = 'camera description'
+    img.exif.primary.Artist = 'Camera Owner'
+    img.exif.primary.Make = 'Camera'
+    img.exif.primary.ExtendedEXIF.DateTimeOriginal = '2018:01:01 00:00:00'
+    return img.writeString()
+
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 2 * 1024 * 1024
+    loops = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    data = jpeg(size)
+
+    print "%d KB jpeg, %d writes" % (size / 1024, loops)
+    with open(os.devnull, 'wb') as fdesc:
+        for kind, image in (('without exif', data),
+                            ('with exif', with_camera_exif(data))):
+            for label, method in (('pexif', with_pexif),
+                                  ('exif segment', with_segment)):
+                start = time.time()
+                for _ in range(loops):
+                    method(image, fdesc)
+                elapsed = time.time() - start
+                print "%-12s %-14s %8.2fms per image" % (
+                        kind, label, 1000 * elapsed / loops)
+
+
+if __name__ == '__main__':
+    main()
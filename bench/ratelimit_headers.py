@@ -0,0 +1,159 @@
+#!/usr/bin/python
+"""
+Check the soft ratelimit against a local HTTP stand-in of the twitter api
+sending x-rate-limit-* headers: the timeline endpoint is called from
+several threads through `api.Ratelimit` until the limiter stops them.
+
+    PYTHONPATH=. python bench/ratelimit_headers.py [threads]
+"""
+
+import atexit
+import BaseHTTPServer
+import ConfigParser
+import json
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+from download_twitter.api import Ratelimit
+from download_twitter.exception import InternalRateLimit
+from twython.exceptions import TwythonRateLimitError
+
+
+TIMELINE = 'statuses/user_timeline.json'
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, quota, reset, answer_429_after=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           handler)
+        self.lock = threading.Lock()
+        self.remaining = quota
+        self.quota = quota
+        self.reset = reset
+        self.answer_429_after = answer_429_after
+        self.calls = 0
+        self.refused = 0
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            if server.answer_429_after is not None and (
+                    server.calls > server.answer_429_after):
+                # another client spent the quota
+                server.remaining = 0
+            refused = server.remaining <= 0
+            if refused:
+                server.refused += 1
+            else:
+                server.remaining -= 1
+            remaining = server.remaining
+
+        body = json.dumps({'errors': [{'message': 'Rate limit exceeded'}]}
+                          if refused else [])
+        self.send_response(429 if refused else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-rate-limit-limit', str(server.quota))
+        self.send_header('x-rate-limit-remaining', str(remaining))
+        self.send_header('x-rate-limit-reset', str(server.reset))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_api(base_url, limit):
+    directory = tempfile.mkdtemp()
+    # after the ratelimit store is written back at exit
+    atexit.register(shutil.rmtree, directory, True)
+    config = ConfigParser.ConfigParser()
+    config.add_section('main')
+    for option in ('consumer_key', 'consumer_secret', 'access_key',
+                   'access_secret'):
+        config.set('main', option, 'XXXX')
+    config.add_section('path')
+    config.set('path', 'data_dir', directory)
+    config.set('path', 'ratelimit_file', directory + '/ratelimit.pkl')
+    config.add_section('ratelimit')
+    config.set('ratelimit', TIMELINE, str(limit))
+
+    api = Ratelimit(config)
+    api.api_url = base_url + '/%s'
+    return api
+
+
+def call_until_limited(api, threads):
+    """ (calls allowed, 429 answers) """
+    counts = {'calls': 0, 'refused': 0}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                api.get_user_timeline(user_id=1)
+                key = 'calls'
+            except InternalRateLimit:
+                return
+            except TwythonRateLimitError:
+                key = 'refused'
+            with lock:
+                counts[key] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return counts['calls'], counts['refused']
+
+
+def scenario(name, threads, limit, quota, answer_429_after=None):
+    reset = int(time.time()) + 600
+    server = ThreadedServer(quota, reset, answer_429_after)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    api = make_api('http://127.0.0.1:%d' % server.server_address[1], limit)
+    calls, refused = call_until_limited(api, threads)
+    frees_at = api.limiter.frees_at(TIMELINE)
+    server.shutdown()
+
+    print ("%-28s configured %3d, quota %3d: %3d calls, %d answered 429, "
+           "frees %+ds from the reset" % (name, limit, quota, calls, refused,
+                                          frees_at - reset))
+    return calls, refused, frees_at - reset
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+    # the first calls go through before the headers are known: at most one
+    # per thread beyond the quota
+    calls, refused, late = scenario('quota above the config', threads,
+                                    5, 40)
+    assert calls + refused <= 40 + threads and late == 0, (calls, refused)
+    assert calls >= 40 - threads, calls
+
+    calls, refused, late = scenario('quota below the config', threads,
+                                    180, 12)
+    assert calls == 12 and refused <= threads and late == 0, (calls, refused)
+
+    calls, refused, late = scenario('quota spent by someone else', threads,
+                                    180, 100, answer_429_after=20)
+    assert calls <= 20 and refused <= threads and late == 0, (calls,
+                                                              refused)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""
+Benchmark the tweets cache: one pickle per friend (MultiPkl) against the
+TweetArchive segments, on a synthetic archive.
+
+    PYTHONPATH=. python bench/tweet_archive.py [statuses] [friends] [new]
+"""
+
+import operator
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from download_twitter.cache import TweetArchive
+
+
+def status(status_id):
+    return {
+        'created_at': 'Mon Jan 01 00:00:00 +0000 2018',
+        'id': status_id,
+        'text': 'synthetic status number %d http://t.co/abcdefghij' % (
+                status_id),
+        'user': {'screen_name': 'friend', 'name': 'Friend'},
+        'restatus': False,
+    }
+
+
+def pickle_run(directory, friends, new):
+    """ what cache_all_friend_tweets did: load, max, extend, dump """
+    for friend in range(friends):
+        filename = os.path.join(directory, str(friend))
+        with open(filename, 'rb') as pkl_file:
+            statuses = pickle.load(pkl_file)
+        last = max(statuses, key=operator.itemgetter('id'))['id']
+        statuses.extend([status(last + i) for i in range(1, new + 1)])
+        with open(filename, 'wb') as pkl_file:
+            pickle.dump(statuses, pkl_file)
+
+
+def archive_run(directory, friends, new):
+    """ max_id from the header, append the new segment """
+    archive = TweetArchive(directory)
+    for friend in range(friends):
+        key = str(friend)
+        last = archive.max_id(key)
+        archive.append(key, [status(last + i) for i in range(1, new + 1)])
+        archive.free(key)
+
+
+def silent(method, *args):
+    """ call method without the retrieve/backup prints, return its time """
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        start = time.time()
+        method(*args)
+        return time.time() - start
+    finally:
+        sys.stdout = stdout
+
+
+def populate(pkl_dir, arc_dir, friends, per_friend):
+    archive = TweetArchive(arc_dir)
+    for friend in range(friends):
+        statuses = [status(friend * per_friend + i)
+                    for i in range(per_friend)]
+        with open(os.path.join(pkl_dir, str(friend)), 'wb') as pkl_file:
+            pickle.dump(statuses, pkl_file)
+        archive[str(friend)] = statuses
+        archive.free(str(friend))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    friends = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    new = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    per_friend = total / friends
+
+    pkl_dir = tempfile.mkdtemp()
+    arc_dir = tempfile.mkdtemp()
+    try:
+        silent(populate, pkl_dir, arc_dir, friends, per_friend)
+        print "%d statuses, %d friends, %d new statuses per friend" % (
+                per_friend * friends, friends, new)
+        print "%-20s %8.2fs" % ('pickle per friend',
+                                silent(pickle_run, pkl_dir, friends, new))
+        print "%-20s %8.2fs" % ('segment archive',
+                                silent(archive_run, arc_dir, friends, new))
+
+        archive = TweetArchive(arc_dir)
+        assert archive.header('0')['count'] == per_friend + new
+        assert len(archive['0']) == per_friend + new
+    finally:
+        shutil.rmtree(pkl_dir)
+        shutil.rmtree(arc_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+"""
+Convert the tweets_dir from one pickle per friend to the TweetArchive
+segments and headers.
+"""
+
+import glob
+import os
+import pickle
+
+from download_twitter.config import get_config
+from download_twitter.cache import TweetArchive
+
+
+def main(config):
+    tweets_dir = config.get('path', 'tweets_dir')
+    archive = TweetArchive(tweets_dir)
+
+    old_files = [(os.stat(i).st_mtime, i)
+                 for i in glob.glob('%s/*' % tweets_dir)
+                 if os.path.isfile(i) and '.' not in os.path.basename(i)]
+    old_files.sort()
+
+    for mtime, filename in old_files:
+        key = os.path.basename(filename)
+        if key in archive:
+            print "%s already converted" % key
+            continue
+
+        with open(filename, 'rb') as pkl_file:
+            statuses = pickle.load(pkl_file)
+
+        archive[key] = statuses
+        archive.free(key)
+        # keep the friends order, which is the file modification time
+        os.utime(archive.header_filename(key), (mtime, mtime))
+        os.remove(filename)
+        print "%s: %d statuses converted" % (key, len(statuses))
+
+
+if __name__ == '__main__':
+    main(get_config())
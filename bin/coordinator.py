@@ -0,0 +1,224 @@
+#!/usr/bin/python
+"""
+Coordinator of the distributed mode: the friends timelines to fetch are
+queued in the schedule order, the statuses the workers (bin/worker.py)
+bring back are turned into images and videos to download, and the
+downloaded medias are indexed and linked in the daily dir. The state
+(last ids, weights, schedule, index) stays with the coordinator, only one
+runs at a time.
+
+Each round collects what the workers did and queues the next friends, up
+to `timelines` waiting (queue section of the config), then waits `poll`
+seconds. The state is written after the rounds which collected something,
+the friends and lists are read again when bin/refresh_lists.py changed
+them. A friend whose timeline failed `max_attempts` times is queued again
+`retry_after` seconds later.
+
+The image path must be the same for all the hosts (a shared file system).
+The queue database needs a file system with POSIX locks across hosts (NFS
+with lockd), see download_twitter/jobqueue.py.
+The images are not deduplicated on download, run bin/dedupe.py --link for
+that.
+
+    SIGTERM, SIGINT: stop after the current round and write the state
+
+It holds the lock of the cron runs and of bin/daemon.py (see
+download_twitter/lock.py), they write the same stores.
+"""
+
+import signal
+import time
+import traceback
+
+from download_twitter.config import get_config, get_option
+from download_twitter.image import MediaFactory, forget_dirs
+from download_twitter.jobqueue import (JobQueue, job_key, TIMELINE, MEDIA,
+                                       VIDEO, PENDING, LEASED)
+from download_twitter.lock import lock_path, lock_pidfile
+from download_twitter.twitter import Twitter
+from download_twitter.utils import VIDEO as VIDEO_KIND, classify_status
+
+
+class Coordinator(object):
+    """ queue the jobs of the workers and collect their results """
+
+    def __init__(self, config):
+        self._config = config
+        self._stopping = False
+        self.twitter = Twitter(config)
+        self.queue = JobQueue(config)
+        self._timelines = get_option(config, 'queue', 'timelines', 180)
+        self._poll = get_option(config, 'queue', 'poll', 5)
+        self._max_pages = get_option(config, 'download', 'max_pages', 0)
+
+    def on_stop(self, signum, _frame):
+        """ SIGTERM, SIGINT """
+        print "got signal %d, stopping" % signum
+        self._stopping = True
+
+    def queue_timelines(self):
+        """
+        queue the next friends of the schedule not queued yet, up to
+        `timelines` waiting for a worker
+        """
+        waiting = self.queue.stats().get(TIMELINE, {})
+        room = self._timelines - waiting.get(PENDING, 0) - waiting.get(LEASED,
+                                                                       0)
+        if room <= 0:
+            return 0
+
+        queued = self.queue.queued(TIMELINE)
+        jobs = []
+        for friend_id, _, _ in self.twitter.order_friends():
+            if len(jobs) >= room:
+                break
+            key = job_key(TIMELINE, friend_id)
+            if key in queued:
+                continue
+            jobs.append((key, {
+                'friend_id': friend_id,
+                'since_id': self.twitter.friends_last_id.get(friend_id),
+                'account': self.twitter.ring.get(friend_id),
+                'max_pages': self._max_pages,
+            }))
+        return self.queue.put_many(TIMELINE, jobs, renew=True) if jobs else 0
+
+    def queue_medias(self, friend_id, account, statuses):
+        """
+        queue the images and videos of the statuses of a friend, return
+        how many
+        """
+        friend_in_list = self.twitter.listcontent.get('friend_in_list', {})
+        listname = friend_in_list.get(friend_id, '')
+        username = statuses[0]['user']['screen_name'].replace('/', ' ')
+        factory = MediaFactory(self.twitter, self._config, listname, username)
+        common = {'account': account, 'listname': listname,
+                  'username': username}
+
+        jobs, _ = factory.image_jobs(statuses)
+        for media_id, media_url, status, filepath in jobs:
+            payload = dict(common, media_id=media_id, url=media_url,
+                           status=status, filepath=filepath)
+            self.queue.put(MEDIA, job_key(MEDIA, filepath), payload)
+
+        # the short links are resolved here, with the link cache
+        candidates = [status for status in statuses
+                      if VIDEO_KIND in classify_status(status)]
+        resolved = factory.resolve_links(candidates)
+        videos = 0
+        for status in candidates:
+            filepath = factory.video_filepath(status)
+            urls = factory.get_vine_link(status, resolved)
+            if not urls or not factory.should_get_media(None, filepath):
+                continue
+            payload = dict(common, media_id=str(status['id']), urls=urls,
+                           status=status, filepath=filepath)
+            self.queue.put(VIDEO, job_key(VIDEO, filepath), payload)
+            videos += 1
+
+        print "%s : %s, %d statuses, %d images and %d videos queued" % (
+                friend_id, username, len(statuses), len(jobs), videos)
+        return len(jobs) + videos
+
+    def collect_timelines(self):
+        """
+        the timelines fetched by the workers and the ones which failed,
+        return how many
+        """
+        collected = self.queue.collect(TIMELINE)
+        for _, payload, statuses in collected:
+            friend_id = payload['friend_id']
+            medias = 0
+            if statuses:
+                medias = self.queue_medias(friend_id, payload['account'],
+                                           statuses)
+                self.twitter.friends_last_id[friend_id] = statuses[0]['id']
+
+            if medias < 2:
+                self.twitter.weights[friend_id] = (
+                        self.twitter.weights.get(friend_id, 0) + 1)
+            self.twitter.scheduler.fetched(friend_id, medias)
+
+        failed = self.queue.collect_failed(TIMELINE)
+        for _, payload, error in failed:
+            # as a friend without statuses (protected, suspended)
+            friend_id = payload['friend_id']
+            print "%s : timeline failed (%s), queued again in %ds" % (
+                    friend_id, error, self.queue.retry_after)
+            self.twitter.weights[friend_id] = (
+                    self.twitter.weights.get(friend_id, 0) + 1)
+            self.twitter.scheduler.fetched(friend_id, 0)
+        return len(collected) + len(failed)
+
+    def collect_medias(self):
+        """ index the medias downloaded by the workers, link them daily """
+        daily = MediaFactory.prepare_daily(
+                self._config, self.twitter.get_list_content()[0])
+        count = 0
+        for kind in (MEDIA, VIDEO):
+            for _, payload, written in self.queue.collect(kind):
+                if not written:
+                    continue
+                self.twitter.media_index.add(payload['filepath'])
+                if kind == MEDIA:
+                    self.twitter.daily.add(
+                            daily, payload['listname'], payload['username'],
+                            payload['filepath'], payload['media_id'],
+                            payload['status'])
+                count += 1
+        return count
+
+    def round(self):
+        """
+        collect what the workers did, queue the next timelines. Return
+        whether something was collected (the state changed)
+        """
+        forget_dirs()
+        medias = self.collect_medias()
+        timelines = self.collect_timelines()
+        queued = self.queue_timelines()
+        if medias or queued:
+            print "%d medias downloaded, %d timelines queued" % (medias,
+                                                                 queued)
+        return bool(medias or timelines)
+
+    def run(self):
+        """ the coordinator loop """
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+
+        print "coordinator on %s" % self.queue.path
+        self.queue.purge()
+        while not self._stopping:
+            try:
+                self.twitter.reload_lists()
+                changed = self.round()
+            except Exception:
+                traceback.print_exc()
+                # a part of the round may be done
+                changed = True
+            if changed:
+                self.twitter.sync()
+
+            until = time.time() + self._poll
+            while not self._stopping and time.time() < until:
+                time.sleep(min(until - time.time(), 1))
+
+        self.twitter.sync()
+        print self.queue.stats()
+        print "stopped"
+
+
+def main(config):
+    pidfile = lock_path(config)
+    lock = lock_pidfile(pidfile)
+    if lock is None:
+        print "already running (%s)" % pidfile
+        return 1
+
+    Coordinator(config).run()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(get_config()))
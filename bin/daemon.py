@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+Download the medias continuously instead of one run per hour: the state
+stays in memory and is written on disk after each run, a new run starts
+as soon as the timeline ratelimit frees calls (or `interval` seconds after
+the previous one when it went through all the friends).
+
+    SIGTERM, SIGINT: stop after the current friend and write the state
+    SIGHUP: read the config again (download, ratelimit, schedule and dedup
+            options, the paths need a restart)
+
+The friends and lists are read again before each run, a
+bin/refresh_lists.py run updates them while the daemon is up.
+
+It holds the lock of the cron runs (lock_file of the path section, see
+download_twitter/lock.py): it does not start while download_images.sh
+runs, and the cron runs do nothing while it is up.
+"""
+
+import signal
+import time
+import traceback
+
+from download_twitter.config import get_config, get_option
+from download_twitter.lock import lock_path, lock_pidfile
+from download_twitter.twitter import Twitter
+
+
+class Daemon(object):
+    """ loop over `Twitter.run` until a signal stops it """
+
+    def __init__(self, config):
+        self._config = config
+        self._stopping = False
+        self._reloading = False
+        self.twitter = None
+
+    def on_stop(self, signum, _frame):
+        """ SIGTERM, SIGINT """
+        print "got signal %d, stopping" % signum
+        self._stopping = True
+        if self.twitter is not None:
+            self.twitter.stop()
+
+    def on_reload(self, _signum, _frame):
+        """ SIGHUP """
+        self._reloading = True
+
+    def reload(self):
+        """ read the config again """
+        self._reloading = False
+        try:
+            config = get_config()
+            self.twitter.configure(config)
+        except Exception:
+            traceback.print_exc()
+            print "config not reloaded"
+            return
+        self._config = config
+        print "config reloaded"
+
+    def sleep(self, until):
+        """ sleep until `until`, a signal wakes us up """
+        while not self._stopping and not self._reloading:
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 5))
+
+    def run(self):
+        """ the daemon loop """
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_reload)
+
+        self.twitter = Twitter(self._config)
+        while not self._stopping:
+            if self._reloading:
+                self.reload()
+
+            start = time.time()
+            print "run at %s" % time.ctime(start)
+            try:
+                self.twitter.reload_lists()
+                self.twitter.run()
+            except Exception:
+                traceback.print_exc()
+            self.twitter.sync()
+
+            until = self.twitter.next_run()
+            if until <= time.time():
+                until = start + get_option(self._config, 'daemon',
+                                           'interval', 900)
+            print "next run at %s" % time.ctime(until)
+            self.sleep(until)
+
+        print "stopped"
+
+
+def main(config):
+    pidfile = lock_path(config)
+    lock = lock_pidfile(pidfile)
+    if lock is None:
+        print "already running (%s)" % pidfile
+        return 1
+
+    Daemon(config).run()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(get_config()))
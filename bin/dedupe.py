@@ -0,0 +1,50 @@
+#!/usr/bin/python
+"""
+Index the images already in image_path for the deduplication (see
+`download_twitter.dedup`), and with --link replace the duplicates by links
+to the first file of their kind.
+"""
+
+from multiprocessing import cpu_count
+import optparse
+import os
+
+from download_twitter.config import get_config
+from download_twitter.dedup import Deduplicator
+from download_twitter.scanner import Scanner
+
+
+def main(config, processes, link):
+    dedup = Deduplicator(config)
+    scanner = Scanner(config, processes)
+    hashes = scanner.scan()
+    print scanner.stats()
+
+    duplicates = 0
+    linked = 0
+    saved = 0
+    for filepath, digest in sorted(hashes.items()):
+        canonical = dedup.add(digest, filepath)
+        if canonical is None:
+            continue
+
+        duplicates += 1
+        if link and not os.path.samefile(canonical, filepath):
+            saved += os.path.getsize(filepath)
+            dedup.link(canonical, filepath)
+            scanner.remember(filepath, digest)
+            linked += 1
+
+    print "%d images, %d duplicates, %d linked (%d bytes saved)" % (
+            len(hashes), duplicates, linked, saved)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [-j processes] [--link]")
+    parser.add_option('-j', '--processes', type='int', default=cpu_count(),
+                      help='number of hashing processes')
+    parser.add_option('--link', action='store_true', default=False,
+                      help='replace the duplicates by links')
+
+    (options, _) = parser.parse_args()
+    main(get_config(), options.processes, options.link)
@@ -1,9 +1,16 @@
 #!/usr/bin/python
 
 from download_twitter.config import get_config
+from download_twitter.lock import lock_path, lock_pidfile
 from download_twitter.twitter import Twitter
 
 
 if __name__ == '__main__':
-    TWITTER = Twitter(get_config())
+    CONFIG = get_config()
+    # nothing to do while another run, the daemon or the coordinator is up
+    LOCK = lock_pidfile(lock_path(CONFIG))
+    if LOCK is None:
+        raise SystemExit(0)
+
+    TWITTER = Twitter(CONFIG)
     TWITTER.run()
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+"""
+Check the index of the downloaded medias against image_path, and rebuild
+it with --rebuild (after files were removed or added by hand).
+"""
+
+import optparse
+
+from download_twitter.config import get_config
+from download_twitter.mediaindex import MediaIndex
+
+
+def main(config, rebuild):
+    index = MediaIndex(config)
+    stale, missing = index.verify()
+    print "%d medias indexed, %d not on disk anymore, %d not indexed" % (
+            len(index), stale, missing)
+
+    if rebuild and (stale or missing):
+        index.rebuild()
+        print "%d medias indexed" % len(index)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [--rebuild]")
+    parser.add_option('--rebuild', action='store_true', default=False,
+                      help='index the files of image_path again')
+
+    (options, _) = parser.parse_args()
+    main(get_config(), options.rebuild)
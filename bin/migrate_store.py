@@ -0,0 +1,33 @@
+#!/usr/bin/python
+"""
+Migrate the pkl files of the config in their sqlite databases,
+set `backend: sqlite` in the store section of the config afterwards.
+
+The stores are the `PklDict` subclasses, a new store is migrated as soon
+as it names its file (see `PklDict.config_path`).
+"""
+
+from download_twitter.config import get_config
+from download_twitter.cache import PklDict, migrate_pickle, sqlite_path
+
+
+def stores(cls=PklDict):
+    """ the `PklDict` subclasses with a file in the config """
+    for subclass in cls.__subclasses__():
+        if subclass.PATH_OPTION is not None:
+            yield subclass
+        for store in stores(subclass):
+            yield store
+
+
+def main(config):
+    for store in sorted(stores(), key=lambda store: store.PATH_OPTION):
+        for filepath in store.config_paths(config):
+            count = migrate_pickle(filepath)
+            if count is not None:
+                print "%s: %d keys migrated in %s" % (
+                        filepath, count, sqlite_path(filepath))
+
+
+if __name__ == '__main__':
+    main(get_config())
@@ -0,0 +1,18 @@
+#!/usr/bin/python
+"""
+Rebuild the index of the tweets archive, needed when files of tweets_dir
+were added, modified or removed by hand.
+"""
+
+from download_twitter.config import get_config
+from download_twitter.cache import AllTweets
+
+
+def main(config):
+    tweets = AllTweets(config)
+    tweets.rebuild_index()
+    print "%d friends indexed" % len(tweets)
+
+
+if __name__ == '__main__':
+    main(get_config())
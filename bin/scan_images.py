@@ -0,0 +1,37 @@
+#!/usr/bin/python
+"""
+Hash the images of image_path without their exif and list the groups of
+duplicates. Only the files new or modified since the last scan are hashed.
+"""
+
+from multiprocessing import cpu_count
+import optparse
+
+from download_twitter.config import get_config
+from download_twitter.scanner import Scanner
+
+
+def main(config, processes, quiet):
+    scanner = Scanner(config, processes)
+    hashes = scanner.scan()
+    print scanner.stats()
+
+    groups = scanner.duplicates(hashes)
+    if not quiet:
+        for group in groups:
+            print "##########################################"
+            print '\n'.join(group)
+
+    print "%d images, %d groups of duplicates (%d files)" % (
+            len(hashes), len(groups), sum([len(group) for group in groups]))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [-j processes] [-q]")
+    parser.add_option('-j', '--processes', type='int', default=cpu_count(),
+                      help='number of hashing processes')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help='only count the duplicates')
+
+    (options, _) = parser.parse_args()
+    main(get_config(), options.processes, options.quiet)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""
+Replay the tweets archive to compare the schedule policies: every 15
+minutes window, at most `calls` timeline calls are spent on the friends in
+the order of the policy, and we count the medias they bring back.
+
+The activity rates are seeded from the `warmup` days before the replayed
+`days`. With --seed, the rates of the last `warmup` days of the archive
+are stored in the schedule state for the adaptive policy instead.
+"""
+
+from bisect import bisect_right
+import optparse
+
+from download_twitter.activity import ActivityModel, HOUR, timeline
+from download_twitter.cache import (AllTweets, FriendList, ListContent,
+                                    ScheduleState)
+from download_twitter.config import get_config
+from download_twitter.scheduler import FriendScheduler, POLICIES
+
+
+WINDOW = 15 * 60
+# statuses per timeline call
+PAGE = 200
+DAY = 24 * HOUR
+
+
+def load_timelines(config, max_friends):
+    """ {friend id: [(time, medias), ...]} from the tweets archive """
+    tweets = AllTweets(config)
+    timelines = {}
+    for key in sorted(tweets.keys())[:max_friends or None]:
+        timelines[key] = timeline(tweets[key])
+        tweets.free(key)
+    return timelines
+
+
+def simulate(config, policy, timelines, friend_in_list, start, end, calls,
+             warmup):
+    """
+    (medias fetched, medias posted, calls, mean delay in hours) of the
+    `policy` replayed from start to end
+    """
+    config.set('schedule', 'policy', policy)
+    weights = dict([(key, 0) for key in timelines])
+    state = {}
+    scheduler = FriendScheduler(config, timelines, weights, state)
+
+    times = {}
+    positions = {}
+    for key, history in timelines.items():
+        times[key] = [posted for posted, _ in history]
+        positions[key] = bisect_right(times[key], start)
+        state[key] = {'fetched': start}
+        scheduler.activity.seed(state[key], history, start, warmup)
+
+    fetched = 0
+    spent = 0
+    delay = 0.0
+    now = start
+    while now < end:
+        now += WINDOW
+        budget = calls
+        for key, _ in scheduler.order(friend_in_list, now):
+            position = positions[key]
+            last = bisect_right(times[key], now, position)
+            cost = max(1, -(-(last - position) / PAGE))
+            if cost > budget:
+                break
+            budget -= cost
+
+            medias = 0
+            for posted, count in timelines[key][position:last]:
+                medias += count
+                delay += count * (now - posted)
+            positions[key] = last
+
+            if medias < 2:
+                weights[key] += 1
+            scheduler.fetched(key, medias, now)
+            fetched += medias
+            if not budget:
+                break
+        spent += calls - budget
+
+    posted = sum([count for history in timelines.values()
+                  for posted_at, count in history
+                  if start < posted_at <= end])
+    return fetched, posted, spent, delay / fetched / HOUR if fetched else 0
+
+
+def seed(config, timelines, now, warmup):
+    """ store the archive rates in the schedule state """
+    ids = dict([(str(key), key) for key in FriendList(config).keys()])
+    state = ScheduleState(config)
+    activity = ActivityModel(config)
+    seeded = 0
+    for key, history in timelines.items():
+        if key not in ids:
+            continue
+        friend_state = dict(state.get(ids[key], {}))
+        activity.seed(friend_state, history, now, warmup)
+        state[ids[key]] = friend_state
+        seeded += 1
+    print "%d friends seeded" % seeded
+
+
+def main(config, options, policies):
+    timelines = load_timelines(config, options.friends)
+    end = max([history[-1][0] for history in timelines.values() if history]
+              or [0])
+    print "%d friends, archive until %s" % (len(timelines), end)
+
+    if options.seed:
+        seed(config, timelines, end, options.warmup * DAY)
+        return
+
+    friend_in_list = dict([
+            (str(key), value) for key, value in
+            ListContent(config).get('friend_in_list', {}).items()])
+    if not config.has_section('schedule'):
+        config.add_section('schedule')
+
+    start = end - options.days * DAY
+    for policy in policies or sorted(POLICIES):
+        fetched, posted, spent, delay = simulate(
+                config, policy, timelines, friend_in_list, start, end,
+                options.calls, options.warmup * DAY)
+        print ("%-10s %6d/%d medias, %6d calls, %.3f medias per call, "
+               "%.1fh delay" % (policy, fetched, posted, spent,
+                                float(fetched) / spent if spent else 0,
+                                delay))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] [policy ...]")
+    parser.add_option('--days', type='float', default=7,
+                      help='days of archive replayed')
+    parser.add_option('--warmup', type='float', default=30,
+                      help='days of archive the rates are seeded from')
+    parser.add_option('--calls', type='int', default=180,
+                      help='timeline calls per 15 minutes window')
+    parser.add_option('--friends', type='int', default=0,
+                      help='only replay that many friends')
+    parser.add_option('--seed', action='store_true', default=False,
+                      help='store the archive rates in the schedule state')
+
+    (options, args) = parser.parse_args()
+    main(get_config(), options, args)
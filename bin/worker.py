@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""
+Worker of the distributed mode: lease the jobs queued by bin/coordinator.py
+(timelines to fetch, images and videos to download) and run them. Run as
+many workers as wanted, on several hosts: the queue database, the image
+path and the ratelimit (kept in the queue database) are shared, the file
+system of the queue database must lock across hosts (see
+download_twitter/jobqueue.py).
+
+    SIGTERM, SIGINT: stop after the current job, the leased ones are given
+    back
+"""
+
+import os
+import signal
+import socket
+import time
+import traceback
+
+from download_twitter.api import API, ratelimits
+from download_twitter.config import get_config, get_option
+from download_twitter.exception import RateLimit, IncompletePagination
+from download_twitter.image import Image, ensure_dir, forget_dirs
+from download_twitter.jobqueue import JobQueue, TIMELINE, MEDIA, VIDEO
+from download_twitter.ratelimit import SharedRateLimiter
+from download_twitter.shard import MAIN, accounts
+from download_twitter.twitter import TIMELINE as TIMELINE_URL
+from download_twitter.utils import simplify_status
+from vine_dwl import VineDwl
+
+
+class Worker(object):
+    """ lease jobs and run them until a signal stops it """
+
+    def __init__(self, config):
+        self._config = config
+        self._stopping = False
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.queue = JobQueue(config)
+        self._batch = get_option(config, 'queue', 'batch', 4)
+        self._poll = get_option(config, 'queue', 'poll', 5)
+
+        # our own cursors and no ratelimit file, the pickled stores are the
+        # coordinator's
+        self.apis = {}
+        for account in accounts(config):
+            limiter = SharedRateLimiter(self.queue.path, ratelimits(config),
+                                        account=account)
+            self.apis[account] = API(config, account, cursors={},
+                                     limiter=limiter)
+        # account: time its timeline ratelimit frees calls
+        self._limited = {}
+
+        self.handlers = {
+            TIMELINE: self.fetch_timeline,
+            MEDIA: self.download_image,
+            VIDEO: self.download_video,
+        }
+
+    def on_stop(self, signum, _frame):
+        """ SIGTERM, SIGINT """
+        print "got signal %d, stopping" % signum
+        self._stopping = True
+
+    def fetch_timeline(self, api, payload):
+        """
+        the new statuses of a friend, simplified, newest first. Raise
+        `IncompletePagination` rather than give back a part of them
+        """
+        statuses = []
+        for page in api.iter_statuses(payload['friend_id'],
+                                      since_id=payload['since_id'],
+                                      max_pages=payload['max_pages']):
+            statuses.extend([simplify_status(status) for status in page])
+        return statuses
+
+    @staticmethod
+    def download_image(api, payload):
+        """ download an image and write it with its exif, False if empty """
+        data = api.get_image(payload['url'])
+        if not data:
+            return False
+
+        ensure_dir(os.path.dirname(payload['filepath']))
+        Image(payload['media_id'], payload['filepath'], data,
+              payload['status']).write()
+        return True
+
+    @staticmethod
+    def download_video(_api, payload):
+        """ download the video of a status, False if we could not """
+        filepath = payload['filepath']
+        ensure_dir(os.path.dirname(filepath))
+        for url in payload['urls']:
+            try:
+                VineDwl(url).write_video(filepath)
+            except (ValueError, AttributeError) as err:
+                print ('Error in vine retrieve for %s (%s)' %
+                       (url, err))
+        return os.path.exists(filepath)
+
+    def run_job(self, kind, key, payload):
+        """ run a job and give its result (or failure) back to the queue """
+        account = payload.get('account', MAIN)
+        if self._stopping:
+            self.queue.release(key, self.name)
+            return
+
+        if kind == TIMELINE and self._limited.get(account, 0) > time.time():
+            self.queue.release(key, self.name, self._limited[account])
+            return
+
+        api = self.apis[account]
+        try:
+            result = self.handlers[kind](api, payload)
+        except RateLimit:
+            until = api.twitter.limiter.frees_at(TIMELINE_URL)
+            print "Ratelimited (%s) until %s" % (account, time.ctime(until))
+            self._limited[account] = until
+            self.queue.release(key, self.name, until)
+            return
+        except IncompletePagination, err:
+            # a partial timeline would move the last id past the missing
+            # statuses, the whole timeline is fetched again
+            print "    %s incomplete, tried again later" % key
+            self.queue.fail(key, self.name, err)
+            return
+        except Exception, err:
+            traceback.print_exc()
+            self.queue.fail(key, self.name, err)
+            return
+
+        if not self.queue.complete(key, self.name, result):
+            print "    lease of %s expired, result dropped" % key
+
+    def run(self):
+        """ the worker loop """
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+
+        print "worker %s on %s" % (self.name, self.queue.path)
+        while not self._stopping:
+            jobs = self.queue.lease(self.name, self._batch)
+            if not jobs:
+                time.sleep(self._poll)
+                continue
+
+            forget_dirs()
+            for kind, key, payload in jobs:
+                self.run_job(kind, key, payload)
+
+        print "stopped"
+
+
+if __name__ == '__main__':
+    Worker(get_config()).run()
@@ -1,17 +1,16 @@
 #!/bin/bash
 
 BASEDIR=$(dirname $0)
-LOCK="/tmp/download_image.lock"
 
 cd $BASEDIR
 
-if [ ! -f $LOCK ]; then
-    touch $LOCK
-    source workspace/bin/activate;
-    PYTHONPATH=$BASEDIR python bin/download_image.py > /tmp/download_image.log 2> /tmp/download_image.err;
-    deactivate;
-    rm -f $LOCK
-fi
-
-# should add a non duplicate script, but jpg files contain tweet as exif, and that change from one to the other
+# bin/download_image.py does nothing while another run, bin/daemon.py (an
+# alternative to running this script from cron) or bin/coordinator.py holds
+# lock_file of the config; the lock goes with the process, a crash doesn't
+# leave it behind
+source workspace/bin/activate;
+PYTHONPATH=$BASEDIR python bin/download_image.py > /tmp/download_image.log 2> /tmp/download_image.err;
+deactivate;
 
+# duplicates are linked as they are downloaded (dedup section of the config),
+# bin/dedupe.py --link does the same for the images downloaded before
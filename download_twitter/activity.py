@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""
+Activity of the friends: how many medias they post per hour
+"""
+
+import calendar
+import time
+
+from .config import get_option
+from .utils import get_images_from_status
+
+
+HOUR = 3600.0
+TWITTER_TIME = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+def status_time(status):
+    """ timestamp of a status """
+    return calendar.timegm(time.strptime(status['created_at'], TWITTER_TIME))
+
+
+def status_medias(status):
+    """ number of medias of a status """
+    return len(get_images_from_status(status))
+
+
+def timeline(statuses):
+    """ [(time, medias), ...] of the statuses, the oldest first """
+    return sorted([(status_time(status), status_medias(status))
+                   for status in statuses])
+
+
+class ActivityModel(object):
+    """
+    Medias per hour of each friend, an exponentially weighted moving
+    average kept in its `ScheduleState` entry (rate, rate_at).
+
+    Each fetch gives the medias posted since the previous fetch, the older
+    observations count for half after `halflife` hours (activity section
+    of the config). The average starts from `prior` medias per hour, the
+    rate of the friends we know nothing of. A rate never goes under
+    `floor`, so a friend silent for a while is polled again some day.
+    """
+
+    def __init__(self, config):
+        self.halflife = get_option(config, 'activity', 'halflife', 72.0) * HOUR
+        self.prior = get_option(config, 'activity', 'prior', 0.05)
+        self.floor = get_option(config, 'activity', 'floor', 0.005)
+
+    def observe(self, state, medias, now):
+        """
+        Update the rate of `state` with the `medias` found by a fetch done
+        at `now`, before its fetched date is updated
+        """
+        if state.get('fetched') is None:
+            # we don't know since when the medias were posted
+            return
+
+        elapsed = max(now - state['fetched'], 60.0)
+        observed = medias / (elapsed / HOUR)
+        rate = self.prior if state.get('rate') is None else state['rate']
+        weight = 1 - 0.5 ** (elapsed / self.halflife)
+        state['rate'] = rate + weight * (observed - rate)
+        state['rate_at'] = now
+
+    def rate(self, state):
+        """ medias per hour """
+        rate = state.get('rate')
+        return max(self.prior if rate is None else rate, self.floor)
+
+    def expected(self, state, now, horizon=24 * HOUR):
+        """
+        medias posted since the last fetch, over `horizon` for a friend never
+        fetched
+        """
+        fetched = state.get('fetched')
+        elapsed = horizon if fetched is None else max(now - fetched, 0)
+        return self.rate(state) * elapsed / HOUR
+
+    def next_poll(self, state, medias=1.0):
+        """ when the friend should have posted `medias` new medias """
+        return (state.get('fetched') or 0) + medias / self.rate(state) * HOUR
+
+    @staticmethod
+    def archive_rate(history, start, end):
+        """
+        medias per hour posted in [start, end], from the (time, medias) of
+        `history` (see `timeline`)
+        """
+        medias = sum([medias for posted, medias in history
+                      if start <= posted <= end])
+        return medias / max((end - start) / HOUR, 1.0)
+
+    def seed(self, state, history, now, window=30 * 24 * HOUR):
+        """
+        Rate from the (time, medias) `history` of the last `window`
+        seconds, for a friend without one
+        """
+        if state.get('rate') is None:
+            state['rate'] = self.archive_rate(history, now - window, now)
+            state['rate_at'] = now
+        return state['rate']
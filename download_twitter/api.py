@@ -1,15 +1,18 @@
 #!/usr/bin/python
 
 import atexit
-from datetime import datetime
-from download_twitter.cache import Ratelimit as CacheRatelimit
+from download_twitter.cache import Ratelimit as CacheRatelimit, Cursors
 from functools import wraps
 from twython import Twython
-from twython.exceptions import TwythonRateLimitError
+from twython.exceptions import TwythonError
 from requests_oauthlib import OAuth1Session
 
-from .exception import exception_handler
+from .config import get_option
+from .exception import exception_handler, IncompletePagination
 from .cache import put_in_cache
+from .ratelimit import RateLimiter
+from .shard import MAIN, account_section
+from .utils import chunks
 
 
 def paginate(extract, ret_filter):
@@ -23,96 +26,137 @@ def paginate(extract, ret_filter):
                 kwargs['cursor'] = cursor
                 ldata = method(*args, **kwargs)
                 cursor = ldata['next_cursor']
-                data.extend(ldata[extract])
+                data.extend([[datum[key] for key in ret_filter]
+                             for datum in ldata[extract]])
 
-            return [[datum[key] for key in ret_filter] for datum in data]
+            return data
         return _paginate
     return decorator
 
 
+def lazy_paginate(extract, ret_filter):
+    """
+    Lazy `paginate`, the rows are yielded page by page as they come.
+
+    Called with a `checkpoint` name, the next cursor and the rows already
+    yielded are saved in `self.cursors` after each page. When the
+    pagination is interrupted (ratelimit, twitter error), the next call with
+    the same checkpoint yields the saved rows and goes on from the saved
+    cursor instead of starting again from -1.
+    """
+    def decorator(method):
+        page = exception_handler(method)
+
+        @wraps(method)
+        def _paginate(self, *args, **kwargs):
+            checkpoint = kwargs.pop('checkpoint', None)
+            state = self.cursors.get(checkpoint) if checkpoint else None
+            cursor, done = ((state['cursor'], state['rows']) if state
+                            else (-1, []))
+
+            for row in done:
+                yield row
+
+            while cursor:
+                kwargs['cursor'] = cursor
+                ldata = page(self, *args, **kwargs)
+                if ldata is None:
+                    # the page failed, the checkpoint says we are not done
+                    if checkpoint:
+                        self.cursors[checkpoint] = {'cursor': cursor,
+                                                    'rows': done}
+                    return
+
+                rows = [[datum[key] for key in ret_filter]
+                        for datum in ldata[extract]]
+                for row in rows:
+                    yield row
+
+                cursor = ldata['next_cursor']
+                if not checkpoint:
+                    continue
+                if cursor:
+                    done.extend(rows)
+                    self.cursors[checkpoint] = {'cursor': cursor, 'rows': done}
+                elif checkpoint in self.cursors:
+                    del self.cursors[checkpoint]
+        return _paginate
+    return decorator
+
+
+def ratelimits(config):
+    """ endpoint: calls allowed in 15 minutes, from the ratelimit section """
+    return dict([(k, int(v)) for k, v in config.items('ratelimit')])
+
+
 class Ratelimit(Twython):
-    """ Override Twython to use our config file """
+    """
+    Override Twython to use our config file, with the credentials of
+    `account` (see `shard.accounts`). The calls are counted by `limiter`
+    if given, else by a `RateLimiter` on the ratelimit file of the account
+    """
 
-    def __init__(self, config):
-        consumer_key = config.get('main', 'consumer_key')
-        consumer_secret = config.get('main', 'consumer_secret')
-        access_key = config.get('main', 'access_key')
-        access_secret = config.get('main', 'access_secret')
+    def __init__(self, config, account=MAIN, limiter=None):
+        section = account_section(account)
+        consumer_key = config.get(section, 'consumer_key')
+        consumer_secret = config.get(section, 'consumer_secret')
+        access_key = config.get(section, 'access_key')
+        access_secret = config.get(section, 'access_secret')
 
+        # a stalled call must not hold a stop (see `utils.background`)
         Twython.__init__(self,
                          consumer_key,
                          consumer_secret,
                          access_key,
-                         access_secret)
+                         access_secret,
+                         client_args={'timeout': get_option(
+                                config, 'download', 'timeout', 30.0)})
 
         self._request_oauth = OAuth1Session(consumer_key,
                                             consumer_secret,
                                             access_key,
                                             access_secret)
 
-        self.ratelimit = CacheRatelimit(config)
-
-        self.default_ratelimit = dict([(k, int(v))
-                                       for k, v in config.items('ratelimit')])
-        self.initialize_ratelimit()
+        self.account = account
+        self.default_ratelimit = ratelimits(config)
+        if limiter is None:
+            self.ratelimit = CacheRatelimit(
+                    config, None if account == MAIN else section)
+            limiter = RateLimiter(
+                    self.ratelimit,
+                    self.default_ratelimit,
+                    block=get_option(config, 'download', 'wait_ratelimit',
+                                     False))
+        else:
+            self.ratelimit = None
+        self.limiter = limiter
 
         # monkey patch _request to check the ratelimit
         self._rt_request = self._request
         def request(url, *args, **kwargs):
             working_url = self.clean_url(url)
-            if working_url in self.default_ratelimit:
-                self.clean_records(working_url)
-                self.record_call(working_url)
-                self.has_reached_limit(working_url)
-
+            if working_url in self.limiter:
+                self.limiter.acquire(working_url)
             return self._rt_request(url, *args, **kwargs)
 
         self._request = request
+        self.client.hooks['response'].append(self.update_ratelimit)
 
-    def initialize_ratelimit(self):
-        """ set the new methods in ratelimit if any (from conf) """
-        for url in self.default_ratelimit:
-            if not url in self.ratelimit:
-                self.ratelimit[url] = {}
-
-    @staticmethod
-    def clean_url(url):
+    def clean_url(self, url):
         """ we just ratelimit on the last part of the url """
-        return url.replace('https://api.twitter.com/1.1/', '')
-
-    @staticmethod
-    def now():
-        """ return the 15min lapse we are in (since epoc)"""
-        return int(datetime.now().strftime('%s')) / 60
-
-    def clean_records(self, url):
-        """ remove old records """
-        now = self.now()
-        for url in self.ratelimit:
-            self.ratelimit[url] = dict([(date, value)
-                    for date, value in self.ratelimit[url].items()
-                    if date - now < 16])
-
-    def record_call(self, url):
-        """ record that this url is called again in this time laps """
-        now = self.now()
-        if not now in self.ratelimit[url]:
-            self.ratelimit[url][now] = 0
-
-        self.ratelimit[url][now] += 1
-
-    def has_reached_limit(self, url):
-        """ raise if the ratelimit is reach """
-        if self.default_ratelimit[url] == -1:
-            return
-
-        now = self.now()
-        total = 0
-        for date in range(now - 15, now + 1):
-            total += self.ratelimit[url].get(date, 0)
-
-        if total >= self.default_ratelimit[url]:
-            raise TwythonRateLimitError('soft ratelimit reached', 1337)
+        base = '%s/' % (self.api_url % self.api_version)
+        return url.split('?', 1)[0].replace(base, '')
+
+    def update_ratelimit(self, response, *_args, **_kwargs):
+        """
+        requests hook: give the x-rate-limit-* headers of each response
+        (429 included) to the limiter. The headers are taken from the
+        response itself, `_last_call` is shared by the threads
+        """
+        working_url = self.clean_url(response.request.url)
+        if working_url in self.limiter:
+            self.limiter.update(working_url, response.headers)
+        return response
 
     def oauth_get(self, *attr, **kwargs):
         """ proxy for the oauth connection """
@@ -125,11 +169,21 @@ class API(object):
     Add helpers
     """
 
-    def __init__(self, config):
-        """ Init the twitter api and a requests with the good crehencials """
+    def __init__(self, config, account=MAIN, cursors=None, limiter=None):
+        """
+        Init the twitter api and a requests with the good crehencials (of
+        `account`), `cursors` when the pagination checkpoints are shared
+        with another API, `limiter` to count the calls somewhere else than
+        in the ratelimit file (see `Ratelimit`)
+        """
         self._config = config
 
-        self.twitter = Ratelimit(config)
+        self.twitter = Ratelimit(config, account, limiter)
+        self.cursors = Cursors(config) if cursors is None else cursors
+
+        # name (lower case) <-> id index of the users we met
+        self._user_ids = None
+        self._user_names = None
 
         # debug options
         self._call_log = {}
@@ -166,34 +220,115 @@ class API(object):
         request = self.twitter.oauth_get(url)
         return request.content
 
-    def get_statuses(self, friend_id, max_id=None, since_id=None):
-        """ Get all the status a friend published """
-        statuses = self.twitter.get_user_timeline(
+    @exception_handler
+    def get_statuses_page(self, friend_id, max_id=None, since_id=None):
+        """ Get a page of 200 statuses a friend published """
+        return self.twitter.get_user_timeline(
                         user_id=friend_id,
                         count=200,
                         include_rts=1,
                         max_id=max_id,
                         since_id=since_id)
 
-        if len(statuses) == 200:
-            last = statuses[-1]['id']
-            statuses.extend(self.get_statuses(friend_id, max_id=last))
+    def iter_statuses(self, friend_id, max_id=None, since_id=None,
+                      max_pages=0):
+        """
+        Yield the pages of statuses a friend published, newest first.
+        Stop after `max_pages` pages if given. Raise `IncompletePagination`
+        when a page fails, the older statuses were not all yielded
+        """
+        pages = 0
+        while True:
+            statuses = self.get_statuses_page(friend_id,
+                                              max_id=max_id,
+                                              since_id=since_id)
+            if statuses is None:
+                raise IncompletePagination(friend_id)
+            if not statuses:
+                return
+
+            yield statuses
+            pages += 1
+
+            if len(statuses) < 200 or (max_pages and pages >= max_pages):
+                return
+            max_id = statuses[-1]['id'] - 1
 
-        return statuses
+    def get_statuses(self, friend_id, max_id=None, since_id=None):
+        """ Get all the status a friend published """
+        return [status
+                for statuses in self.iter_statuses(friend_id,
+                                                   max_id=max_id,
+                                                   since_id=since_id)
+                for status in statuses]
 
     @exception_handler
     def get_statuses_for_friend(self, friend_id, since_id):
         """ Get all statuses since `since_id` for this friend """
         return self.get_statuses(friend_id, since_id=since_id)
 
+    def known_users(self):
+        """ (id, name) of the users we know without asking twitter """
+        return []
+
+    def remember_users(self, users):
+        """ put (id, name) in the user index """
+        if self._user_ids is None:
+            self._user_ids = {}
+            self._user_names = {}
+            users = list(self.known_users()) + list(users)
+
+        for user_id, user_name in users:
+            self._user_ids[user_name.lower()] = user_id
+            self._user_names[user_id] = user_name
+
     @exception_handler
     def get_friend(self, user_id=None, user_name=None):
         """ Get a friend based on it's id or name """
         assert user_id or user_name, 'You must give a name or id'
-        user = self.twitter.show_user(friend_id=user_id,
+        self.remember_users([])
+        if user_id in self._user_names:
+            return user_id, self._user_names[user_id]
+        if user_name and user_name.lower() in self._user_ids:
+            user_id = self._user_ids[user_name.lower()]
+            return user_id, self._user_names[user_id]
+
+        user = self.twitter.show_user(user_id=user_id,
                                       screen_name=user_name)
+        self.remember_users([(user['id'], user['screen_name'])])
         return user['id'], user['screen_name']
 
+    @exception_handler
+    def lookup_users(self, user_ids=None, user_names=None):
+        """ Get users (id, name) based on their ids or names, 100 by call """
+        users = []
+        for chunk in chunks(user_ids or [], 100):
+            users.extend(self.twitter.lookup_user(
+                    user_id=','.join([str(user_id) for user_id in chunk])))
+        for chunk in chunks(user_names or [], 100):
+            users.extend(self.twitter.lookup_user(
+                    screen_name=','.join(chunk)))
+
+        users = [(user['id'], user['screen_name']) for user in users]
+        self.remember_users(users)
+        return users
+
+    def get_user_ids(self, user_names):
+        """ ids of the users, from the index or looked up by 100 """
+        self.remember_users([])
+        unknown = [name for name in user_names
+                   if name.lower() not in self._user_ids]
+        if unknown:
+            self.lookup_users(user_names=unknown)
+
+        user_ids = []
+        for name in user_names:
+            if name.lower() in self._user_ids:
+                user_ids.append(self._user_ids[name.lower()])
+            else:
+                print "user %s not found" % name
+        return user_ids
+
     @put_in_cache
     @exception_handler
     @paginate('users', ['id', 'screen_name'])
@@ -201,6 +336,11 @@ class API(object):
         """ Cached call - Get all friends (id, name) """
         return self.twitter.get_friends_list(cursor=cursor)
 
+    @lazy_paginate('users', ['id', 'screen_name'])
+    def iter_friends(self, cursor=-1):
+        """ Yield all friends (id, name), see `lazy_paginate` """
+        return self.twitter.get_friends_list(cursor=cursor)
+
     @exception_handler
     def get_list(self, list_id=None, list_name=None):
         """ Get a list based on it's id or name """
@@ -223,49 +363,96 @@ class API(object):
         """ Get all users id from a list """
         return self.twitter.get_list_members(list_id=list_id, cursor=cursor)
 
+    @lazy_paginate('users', ['id', 'screen_name'])
+    def iter_list_users(self, list_id, cursor=-1):
+        """ Yield all users (id, name) from a list, see `lazy_paginate` """
+        return self.twitter.get_list_members(list_id=list_id, cursor=cursor)
+
     @exception_handler
-    def put_user_in_list(self, list_name, user_name):
+    def is_in_list(self, list_name, user_id):
+        """ Is the user a member of the given list """
+        list_id, _list_name = self.get_list(list_name=list_name)
+        try:
+            self.twitter.is_list_member(list_id=list_id, user_id=user_id)
+        except TwythonError, err:
+            if err.error_code == 404:
+                return False
+            raise
+        return True
+
+    @exception_handler
+    def put_users_in_list(self, list_name, user_names):
         """
         WARN : Need RW permissions
-        Put a user in the given list.
+        Put users in the given list, 100 by call.
         """
         list_id, _list_name = self.get_list(list_name=list_name)
-        user_id, _user_name = self.get_friend(user_name=user_name)
-
-        print "putting %s (%s) in list %s (%s)" % (
-               user_name, user_id, list_name, list_id)
-        self.twitter.create_list_members(list_id=list_id, user_id=user_id)
+        user_ids = self.get_user_ids(user_names)
+
+        print "putting %d users in list %s (%s)" % (
+               len(user_ids), list_name, list_id)
+        for chunk in chunks(user_ids, 100):
+            self.twitter.create_list_members(
+                    list_id=list_id,
+                    user_id=','.join([str(user_id) for user_id in chunk]))
         return True
 
     @exception_handler
-    def del_user_from_list(self, list_name, user_name):
+    def del_users_from_list(self, list_name, user_names):
         """
         WARN : Need RW permissions
-        Remove a user from the given list.
+        Remove users from the given list, 100 by call.
         """
         list_id, _list_name = self.get_list(list_name=list_name)
-        user_id, _user_name = self.get_friend(user_name=user_name)
-
-        print "removing %s (%s) from list %s (%s)" % (
-               user_name, user_id, list_name, list_id)
-        self.twitter.delete_list_member(list_id=list_id, user_id=user_id)
+        user_ids = self.get_user_ids(user_names)
+
+        print "removing %d users from list %s (%s)" % (
+               len(user_ids), list_name, list_id)
+        for chunk in chunks(user_ids, 100):
+            self.twitter.delete_list_members(
+                    list_id=list_id,
+                    user_id=','.join([str(user_id) for user_id in chunk]))
         return True
 
+    def put_user_in_list(self, list_name, user_name):
+        """
+        WARN : Need RW permissions
+        Put a user in the given list.
+        """
+        return self.put_users_in_list(list_name, [user_name])
+
+    def del_user_from_list(self, list_name, user_name):
+        """
+        WARN : Need RW permissions
+        Remove a user from the given list.
+        """
+        return self.del_users_from_list(list_name, [user_name])
+
     def retrieve_list_content(self):
         """
-        Get list content and friends in list
+        Get list content and friends in list, and the names of the lists
+        whose members could not all be read (left out of the content)
         """
         list_content = {}
         friend_in_list = {}
+        incomplete = []
 
         for list_id, list_name in self.get_lists():
-            friends = dict(self.get_list_users(list_id))
+            checkpoint = 'list_members:%s' % list_id
+            friends = dict(self.iter_list_users(list_id,
+                                                checkpoint=checkpoint))
+            if checkpoint in self.cursors:
+                print "list %s incomplete, will go on next time" % list_name
+                incomplete.append(list_name)
+                continue
+
             list_content[list_name] = friends.keys()
             friend_in_list.update(
                     dict([(friend_id, list_name) for friend_id in friends]))
         return {
             'list_content': list_content,
             'friend_in_list': friend_in_list,
+            'incomplete': incomplete,
         }
 
     def __repr__(self):
@@ -7,8 +7,14 @@ import atexit
 from functools import wraps
 import glob
 import pickle
+import sqlite3
+import threading
+import time
 from types import DictType
 
+from .config import get_option
+from .shard import accounts, account_section
+
 
 class Cache(object):
     """ Container for cached values """
@@ -33,25 +39,285 @@ def put_in_cache(method):
     return _cached_value
 
 
+def load_pickle(filepath):
+    """ Load a pickled dict, empty if the file does not exists """
+    if not os.path.exists(filepath):
+        return {}
+
+    print "retrieve %s" % filepath
+    pkl_file = open(filepath, 'rb')
+    try:
+        return pickle.load(pkl_file)
+    except EOFError:
+        return {}
+    finally:
+        pkl_file.close()
+
+
+def dump_pickle(filepath, value):
+    """
+    Pickle value in filepath, through a temporary file so a crash or a full
+    disk never leave a truncated file behind
+    """
+    tmp_filepath = '%s.tmp' % filepath
+    pkl_file = open(tmp_filepath, 'wb')
+    try:
+        pickle.dump(value, pkl_file, pickle.HIGHEST_PROTOCOL)
+        pkl_file.flush()
+        os.fsync(pkl_file.fileno())
+    finally:
+        pkl_file.close()
+    os.rename(tmp_filepath, filepath)
+
+
+def file_stamp(filepath):
+    """
+    (inode, mtime, size) of a file, None if it does not exist: a pickle
+    dumped again is a new file (see `dump_pickle`)
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def sqlite_path(filepath):
+    """ the sqlite database replacing the pkl file `filepath` """
+    return '%s.db' % os.path.splitext(filepath)[0]
+
+
+def store_options(config):
+    """ PklDict options from the store section of the config """
+    return {
+        'backend': get_option(config, 'store', 'backend', 'pickle'),
+        'commit_every': get_option(config, 'store', 'commit_every', 20),
+        'commit_interval': get_option(config, 'store', 'commit_interval',
+                                      30.0),
+    }
+
+
+class SqliteStore(object):
+    """
+    dict like access to a sqlite database (WAL mode), one row per key.
+
+    Values are read when asked for, each `__setitem__` is written in the
+    current transaction and the transaction is committed every
+    `commit_every` writes or `commit_interval` seconds.
+    Mutable values got from the store can be modified in place, they are
+    written back on commit.
+    """
+    IMMUTABLE = (int, long, float, basestring, tuple, type(None))
+
+    def __init__(self, filepath, commit_every=20, commit_interval=30.0):
+        self.filepath = filepath
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS store '
+                         '(key PRIMARY KEY, value BLOB)')
+        self._db.commit()
+        self._closed = False
+
+        self._loaded = {}
+        self._watched = set()
+        self._writes = 0
+        self._last_commit = time.time()
+
+    @staticmethod
+    def _dumps(value):
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _load(self, key, blob):
+        """ unpickle a value and remember it if it can change in place """
+        value = pickle.loads(str(blob))
+        self._loaded[key] = value
+        if not isinstance(value, self.IMMUTABLE):
+            self._watched.add(key)
+        return value
+
+    def _write(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO store (key, value) '
+                         'VALUES (?, ?)', (key, self._dumps(value)))
+        self._writes += 1
+        if (self._writes >= self._commit_every or
+                time.time() - self._last_commit > self._commit_interval):
+            self.commit()
+
+    def commit(self):
+        """ write back the values modified in place and commit """
+        with self._lock:
+            for key in self._watched:
+                self._db.execute('UPDATE store SET value = ? WHERE key = ?',
+                                 (self._dumps(self._loaded[key]), key))
+            self._db.commit()
+            self._writes = 0
+            self._last_commit = time.time()
+
+    def close(self, commit=True):
+        """ commit (unless told not to) and close the database """
+        with self._lock:
+            if self._closed:
+                return
+            if commit:
+                self.commit()
+            self._db.close()
+            self._closed = True
+
+    def forget(self):
+        """ drop the values read so far, they are read again when asked """
+        with self._lock:
+            self._loaded.clear()
+            self._watched.clear()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM store').fetchone()[0]
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._loaded:
+                return self._loaded[key]
+
+            row = self._db.execute('SELECT value FROM store WHERE key = ?',
+                                   (key, )).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return self._load(key, row[0])
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._loaded[key] = value
+            if isinstance(value, self.IMMUTABLE):
+                self._watched.discard(key)
+            else:
+                self._watched.add(key)
+            self._write(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._loaded.pop(key, None)
+            self._watched.discard(key)
+            self._db.execute('DELETE FROM store WHERE key = ?', (key, ))
+            self._writes += 1
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._loaded:
+                return True
+            return self._db.execute('SELECT 1 FROM store WHERE key = ?',
+                                    (key, )).fetchone() is not None
+
+    def get(self, key, value=None):
+        try:
+            return self[key]
+        except KeyError:
+            return value
+
+    def keys(self):
+        with self._lock:
+            return [row[0] for row in
+                    self._db.execute('SELECT key FROM store')]
+
+    def items(self):
+        with self._lock:
+            return [(key, self._loaded[key] if key in self._loaded
+                          else self._load(key, blob))
+                    for key, blob in
+                    self._db.execute('SELECT key, value FROM store').fetchall()]
+
+    def update(self, values):
+        """ write a whole dict in one transaction """
+        with self._lock:
+            for key, value in values.items():
+                self._loaded[key] = value
+                if not isinstance(value, self.IMMUTABLE):
+                    self._watched.add(key)
+                self._db.execute('INSERT OR REPLACE INTO store (key, value) '
+                                 'VALUES (?, ?)', (key, self._dumps(value)))
+            self.commit()
+
+    def __repr__(self):
+        return dict(self.items()).__repr__()
+
+
+def migrate_pickle(filepath):
+    """
+    One shot migration of the pkl file `filepath` in its sqlite database.
+    Return the number of keys migrated, None if there was nothing to do.
+    """
+    if not os.path.exists(filepath):
+        return None
+
+    store = SqliteStore(sqlite_path(filepath))
+    try:
+        if len(store):
+            print "%s already migrated" % store.filepath
+            return None
+
+        values = load_pickle(filepath)
+        store.update(values)
+        return len(values)
+    finally:
+        store.close()
+
+
 class PklDict(DictType):
-    """ Load a pkl file in an dict and give access to it """
+    """
+    Load a pkl file in an dict and give access to it
 
-    def __init__(self, filepath):
+    With the `pickle` backend the whole file is loaded at start and written
+    back at exit (or on `sync`), with the `sqlite` backend each key is
+    read and written on its own in a database next to the pkl file.
+
+    A `readonly` store is never written back, for a process which only
+    reads a store another one writes (see `reload`).
+
+    The stores of the config name their file with `PATH_OPTION` (path
+    section), `DEFAULT_FILE` in data_dir if the option is not required.
+    """
+    readonly = False
+    PATH_OPTION = None
+    DEFAULT_FILE = None
+
+    def __init__(self, filepath, backend='pickle', commit_every=20,
+                 commit_interval=30.0):
         self.filepath = filepath
+        self.backend = backend
 
-        if os.path.exists(self.filepath):
-            print "retrieve %s" % self.filepath
-            pkl_file = open(self.filepath, 'rb')
-            try:
-                self._internal = pickle.load(pkl_file)
-            except EOFError:
-                self._internal = {}
-            pkl_file.close()
+        if backend == 'sqlite':
+            self._internal = SqliteStore(sqlite_path(self.filepath),
+                                         commit_every, commit_interval)
         else:
-            self._internal = {}
+            self._stamp = file_stamp(self.filepath)
+            self._internal = load_pickle(self.filepath)
 
         atexit.register(self.exit)
 
+    @classmethod
+    def config_path(cls, config):
+        """ the pkl file of the store in config """
+        if cls.DEFAULT_FILE is None:
+            return config.get('path', cls.PATH_OPTION)
+        return get_option(config, 'path', cls.PATH_OPTION,
+                          os.path.join(config.get('path', 'data_dir'),
+                                       cls.DEFAULT_FILE))
+
+    @classmethod
+    def config_paths(cls, config):
+        """ all the pkl files of the store in config (see `Ratelimit`) """
+        return [cls.config_path(config)]
+
     def __len__(self):
         return len(self._internal)
 
@@ -82,36 +348,88 @@ class PklDict(DictType):
     def __repr__(self):
         return self._internal.__repr__()
 
+    def reload(self):
+        """
+        read the store again, for the changes made by another process.
+        A pickle is only read if its file changed, return whether it was
+        """
+        if self.backend == 'sqlite':
+            self._internal.forget()
+            return True
+
+        stamp = file_stamp(self.filepath)
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        self._internal = load_pickle(self.filepath)
+        return True
+
+    def sync(self):
+        """ make sure everything is on disk """
+        if self.readonly:
+            return
+        if self.backend == 'sqlite':
+            self._internal.commit()
+        else:
+            dump_pickle(self.filepath, self._internal)
+            self._stamp = file_stamp(self.filepath)
+
     def exit(self):
         """ backup internal into the pkl file at the end """
+        if self.backend == 'sqlite':
+            self._internal.close(commit=not self.readonly)
+            return
+        if self.readonly:
+            return
         print "backup %s"% self.filepath
-        pkl_file = open(self.filepath, 'wb')
-        pickle.dump(self._internal, pkl_file)
-        pkl_file.close()
+        dump_pickle(self.filepath, self._internal)
 
 
 class LastId(PklDict):
     """ Load the last id file and save it when done """
+    PATH_OPTION = 'friends_last_id_file'
 
     def __init__(self, config):
         """ Open or create the last id file """
-        PklDict.__init__(self, config.get('path', 'friends_last_id_file'))
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
 
 
 class FriendList(PklDict):
     """ Load the friend list file and save it when done """
+    PATH_OPTION = 'friends_list_file'
 
     def __init__(self, config):
         """ Open or create the friend list file """
-        PklDict.__init__(self, config.get('path', 'friends_list_file'))
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
 
 
 class ListContent(PklDict):
     """ Load the list content file and save it when done """
+    PATH_OPTION = 'list_content_file'
 
     def __init__(self, config):
         """ Open or create the list content file """
-        PklDict.__init__(self, config.get('path', 'list_content_file'))
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+    def refresh(self, content):
+        """
+        store the `content` of `api.API.retrieve_list_content`, the lists
+        not read to the end keep their previous members
+        """
+        old_content = self.get('list_content', {})
+        old_in_list = self.get('friend_in_list', {})
+        for list_name in content.pop('incomplete'):
+            members = old_content.get(list_name, [])
+            content['list_content'][list_name] = members
+            content['friend_in_list'].update(dict([
+                    (friend_id, list_name) for friend_id in members
+                    if old_in_list.get(friend_id) == list_name]))
+
+        for key, value in content.items():
+            self[key] = value
 
 
 class WeightFriends(PklDict):
@@ -119,49 +437,247 @@ class WeightFriends(PklDict):
     Load a dict containing a weight per friend to get differents friendsi
     when we dont get them all because of ratelimits
     """
+    PATH_OPTION = 'friends_weight_file'
 
     def __init__(self, config):
-        PklDict.__init__(self, config.get('path', 'friends_weight_file'))
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
 
 
 class Ratelimit(PklDict):
-    def __init__(self, config):
-        """ Open or create the ratelimit file """
-        PklDict.__init__(self, config.get('path', 'ratelimit_file'))
+    PATH_OPTION = 'ratelimit_file'
+
+    def __init__(self, config, account=None):
+        """
+        Open or create the ratelimit file, the one of the `account`
+        section (see `shard.account_section`) if given
+        """
+        PklDict.__init__(self, self.config_path(config, account),
+                         **store_options(config))
+
+    @classmethod
+    def config_path(cls, config, account=None):
+        """ the ratelimit file of the `account` section if given """
+        if account is None:
+            return config.get('path', cls.PATH_OPTION)
+        return get_option(
+                config, account, cls.PATH_OPTION,
+                os.path.join(config.get('path', 'data_dir'),
+                             'ratelimit_%s.pkl' % account.split(':')[-1]))
+
+    @classmethod
+    def config_paths(cls, config):
+        """ the ratelimit files of all the accounts """
+        return [cls.config_path(config)] + [
+                cls.config_path(config, account_section(account))
+                for account in accounts(config)[1:]]
 
 
 class DeletedFriends(PklDict):
     """ Load the list of deleted friends """
+    PATH_OPTION = 'deleted_friends_file'
+
     def __init__(self, config):
-        PklDict.__init__(self, config.get('path', 'deleted_friends_file'))
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class Cursors(PklDict):
+    """ Load the pagination checkpoints (see `api.lazy_paginate`) """
+    PATH_OPTION = 'cursors_file'
+    DEFAULT_FILE = 'cursors.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class LinkStore(PklDict):
+    """ Load the short links resolutions (see `links.LinkCache`) """
+    PATH_OPTION = 'link_cache_file'
+    DEFAULT_FILE = 'links.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class MediaHashes(PklDict):
+    """ Load the image hash -> stored file index (see `dedup.Deduplicator`) """
+    PATH_OPTION = 'media_hash_file'
+    DEFAULT_FILE = 'media_hashes.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class ScanCache(PklDict):
+    """
+    Load the image path -> (size, mtime, hash) cache of the last scan
+    (see `scanner.Scanner`)
+    """
+    PATH_OPTION = 'scan_cache_file'
+    DEFAULT_FILE = 'scan_cache.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class ScheduleState(PklDict):
+    """
+    Load the friend id -> polling state (last fetch, fetches, medias)
+    (see `scheduler.FriendScheduler`)
+    """
+    PATH_OPTION = 'schedule_file'
+    DEFAULT_FILE = 'schedule.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
+
+
+class TweetJournal(PklDict):
+    """
+    Load the friend id -> progress of the tweets archive pass (see
+    `twitter.Twitter.cache_all_friend_tweets`)
+    """
+    PATH_OPTION = 'tweets_journal_file'
+    DEFAULT_FILE = 'tweets_journal.pkl'
+
+    def __init__(self, config):
+        PklDict.__init__(self, self.config_path(config),
+                         **store_options(config))
 
 
 class MultiPkl(DictType):
+    """
+    One pkl file per key in a directory.
+
+    The keys are listed from an index file (key -> mtime, size, max_id,
+    count) loaded once, call `rebuild_index` when the directory was
+    modified by something else. The entries updated by `free` are appended
+    to an index log, folded in the index file by `sync` and at exit.
+    """
+    INDEX = '.index'
+    INDEX_LOG = '.index.log'
+
     def __init__(self, filepath):
         self.filepath = filepath
         self._loaded = {}
         self._modified = set()
+        self._index = None
         atexit.register(self.exit)
 
     def _filenames(self, key):
         return os.path.join(self.filepath, "%s" % key)
 
-    def __list_files(self):
-        ext_files = [(os.stat(i).st_mtime, os.path.basename(i))
-                     for i in glob.glob('%s/*' % self.filepath)
-                     if os.path.isfile(i)]
+    def _index_filename(self):
+        return os.path.join(self.filepath, self.INDEX)
+
+    def _index_log_filename(self):
+        return os.path.join(self.filepath, self.INDEX_LOG)
+
+    def _scan(self):
+        """ the keys present in the directory """
+        return [os.path.basename(i)
+                for i in glob.glob('%s/*' % self.filepath)
+                if os.path.isfile(i)]
+
+    @staticmethod
+    def describe(value):
+        """ (max_id, count) of a list of statuses """
+        try:
+            return max([status['id'] for status in value] or [None]), len(value)
+        except (TypeError, KeyError):
+            return None, None
+
+    def _index_entry(self, key, value=None):
+        """ index entry of `key`, loaded from its file if value is None """
+        stat = os.stat(self._filenames(key))
+        if value is None:
+            with open(self._filenames(key), 'rb') as pkl_file:
+                value = pickle.load(pkl_file)
+        max_id, count = self.describe(value)
+        return {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'max_id': max_id,
+            'count': count,
+        }
+
+    @property
+    def index(self):
+        """ the key index, loaded on first use """
+        if self._index is None:
+            filename = self._index_filename()
+            if os.path.exists(filename):
+                with open(filename, 'rb') as index_file:
+                    self._index = pickle.load(index_file)
+                self._replay_index_log()
+            else:
+                self.rebuild_index()
+        return self._index
+
+    def _replay_index_log(self):
+        """ apply the entries logged since the index file was written """
+        filename = self._index_log_filename()
+        if not os.path.exists(filename):
+            return
+
+        with open(filename, 'rb') as log_file:
+            while True:
+                try:
+                    key, entry = pickle.load(log_file)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    # the end, or what a crash left of the last entry
+                    break
+                if entry is None:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = entry
+
+    def rebuild_index(self):
+        """ rebuild the index from the files """
+        print "indexing %s" % self.filepath
+        self._index = dict([(key, self._index_entry(key))
+                            for key in self._scan()])
+        self._write_index()
+
+    def _write_index(self):
+        if os.path.isdir(self.filepath):
+            dump_pickle(self._index_filename(), self._index)
+            if os.path.exists(self._index_log_filename()):
+                os.remove(self._index_log_filename())
+
+    def _log_index(self, key):
+        """ log the index entry of `key` (None when it was removed) """
+        with open(self._index_log_filename(), 'ab') as log_file:
+            pickle.dump((key, self.index.get(key)), log_file,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def sync(self):
+        """ fold the index log in the index file """
+        if self._index is not None and os.path.exists(
+                self._index_log_filename()):
+            self._write_index()
+
+    def _list_files(self):
+        ext_files = [(entry['mtime'], key)
+                     for key, entry in self.index.items()]
         ext_files.sort()
         return [i[1] for i in ext_files]
 
     def keys(self):
-        return self.__list_files()
+        return self._list_files()
 
     def __len__(self):
-        return len(self.__list_files())
+        return len(self.index)
 
     def __getitem__(self, key):
         keyfile = self._filenames(key)
-        if not os.path.exists(keyfile):
+        if key not in self._loaded and key not in self.index:
             raise KeyError('%s does not exists' % key)
 
         if key not in self._loaded:
@@ -180,7 +696,7 @@ class MultiPkl(DictType):
         raise NotImplemented('cant del on MultiPkl right now')
 
     def __iter__(self):
-        return self.__list_files()
+        return iter(self._list_files())
 
     def get(self, key, value=None):
         try:
@@ -197,22 +713,214 @@ class MultiPkl(DictType):
             pkl_file = open(keyfile, 'wb')
             pickle.dump(self._loaded[key], pkl_file)
             pkl_file.close()
+            self.index[key] = self._index_entry(key, self._loaded[key])
+            self._log_index(key)
         else:
             self._loaded.pop(key)
         self._modified.discard(key)
 
     def __contains__(self, key):
-        return key in self.__list_files()
+        return key in self.index
 
     def __repr__(self):
-        return '{%s}' % ', '.join(self.__list_files())
+        return '{%s}' % ', '.join(self._list_files())
+
+    def exit(self):
+        for key in list(self._modified):
+            self.free(key)
+        self.sync()
+
+
+class TweetArchive(MultiPkl):
+    """
+    Append only archive of statuses, for each key there is:
+      * `<key>.seg` segments of statuses written one after the other, each
+        segment is a pickled dict of columns (field -> list of values)
+      * `<key>.hdr` a small pickled header {'max_id', 'count', 'segments',
+        'size'}, size is the length of the valid segments in the seg file
+
+    Appending only writes the new segment and the header, the newest id
+    of a key is read from its header.
+    """
+    SEGMENTS = '%s.seg'
+    HEADER = '%s.hdr'
+
+    def __init__(self, filepath):
+        MultiPkl.__init__(self, filepath)
+        self._headers = {}
+        self._pending = {}
+
+    def _filenames(self, key):
+        return os.path.join(self.filepath, self.SEGMENTS % key)
+
+    def header_filename(self, key):
+        return os.path.join(self.filepath, self.HEADER % key)
+
+    def _scan(self):
+        return [os.path.basename(i)[:-4]
+                for i in glob.glob(self.HEADER % ('%s/*' % self.filepath))]
+
+    def _index_entry(self, key, value=None):
+        header = self.header(key) if value is None else value
+        stat = os.stat(self.header_filename(key))
+        return {
+            'mtime': stat.st_mtime,
+            'size': header['size'],
+            'max_id': header['max_id'],
+            'count': header['count'],
+        }
+
+    @staticmethod
+    def to_columns(statuses):
+        """ statuses to a column segment, missing fields are set to None """
+        fields = set()
+        for status in statuses:
+            fields.update(status)
+        return dict([(field, [status.get(field) for status in statuses])
+                     for field in fields])
+
+    @staticmethod
+    def from_columns(columns):
+        """ column segment to statuses, None values are left out """
+        fields = columns.items()
+        count = len(fields[0][1]) if fields else 0
+        return [dict([(field, values[i]) for field, values in fields
+                      if values[i] is not None])
+                for i in range(count)]
+
+    def header(self, key):
+        """ the header of `key`, None if it is not archived """
+        if key not in self._headers:
+            filename = self.header_filename(key)
+            if not os.path.exists(filename):
+                return None
+            with open(filename, 'rb') as hdr_file:
+                self._headers[key] = pickle.load(hdr_file)
+        return self._headers[key]
+
+    def max_id(self, key):
+        """ the newest status id archived for `key` """
+        entry = self.index.get(key)
+        return entry['max_id'] if entry else None
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            if key not in self.index and key not in self._pending:
+                raise KeyError('%s does not exists' % key)
+            header = self.header(key)
+
+            statuses = []
+            if header:
+                keyfile = self._filenames(key)
+                print "retrieve %s" % keyfile
+                with open(keyfile, 'rb') as seg_file:
+                    for _ in range(header['segments']):
+                        statuses.extend(
+                                self.from_columns(pickle.load(seg_file)))
+            statuses.extend(self._pending.get(key, []))
+            self._loaded[key] = statuses
+
+        return self._loaded[key]
+
+    def __setitem__(self, key, value):
+        """ replace all the statuses of `key`, rewritten on `free` """
+        self._loaded[key] = value
+        self._pending.pop(key, None)
+        self._modified.add(key)
+
+    def append(self, key, statuses):
+        """ add statuses to `key`, only them are written on `free` """
+        if not statuses:
+            return
+
+        if key in self._modified:
+            self._loaded[key].extend(statuses)
+            return
+
+        self._pending.setdefault(key, []).extend(statuses)
+        if key in self._loaded:
+            self._loaded[key].extend(statuses)
+
+    def discard(self, key):
+        """ forget what was not written yet for `key` """
+        self._loaded.pop(key, None)
+        self._pending.pop(key, None)
+        self._modified.discard(key)
+
+    def rollback(self, key, header):
+        """
+        Go back to `header` of `key` (None when nothing was archived), the
+        segments written after it are dropped by the next append
+        """
+        self.discard(key)
+        if header is None:
+            for filename in (self._filenames(key), self.header_filename(key)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self._headers.pop(key, None)
+            self.index.pop(key, None)
+        else:
+            dump_pickle(self.header_filename(key), header)
+            self._headers[key] = header
+            self.index[key] = self._index_entry(key, header)
+        self._log_index(key)
+
+    def _write_segment(self, key, statuses, header):
+        """ append a segment to the seg file and write the header after """
+        keyfile = self._filenames(key)
+        print "backup %s" % keyfile
+        with open(keyfile, 'ab') as seg_file:
+            # drop what a crash could have left after the last header
+            seg_file.truncate(header['size'])
+            pickle.dump(self.to_columns(statuses), seg_file,
+                        pickle.HIGHEST_PROTOCOL)
+            seg_file.flush()
+            os.fsync(seg_file.fileno())
+            size = seg_file.tell()
+
+        ids = [status['id'] for status in statuses]
+        header = {
+            'max_id': max([header['max_id']] + ids),
+            'count': header['count'] + len(statuses),
+            'segments': header['segments'] + 1,
+            'size': size,
+        }
+        dump_pickle(self.header_filename(key), header)
+        self._headers[key] = header
+        self.index[key] = self._index_entry(key, header)
+        self._log_index(key)
+
+    def free(self, key):
+        empty = {'max_id': None, 'count': 0, 'segments': 0, 'size': 0}
+
+        if key in self._modified:
+            for filename in (self._filenames(key), self.header_filename(key)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self._headers.pop(key, None)
+            self.index.pop(key, None)
+            if self._loaded[key]:
+                self._write_segment(key, self._loaded[key], empty)
+            else:
+                self._log_index(key)
+        elif key in self._pending:
+            self._write_segment(key, self._pending[key],
+                                self.header(key) or empty)
+
+        self._loaded.pop(key, None)
+        self._pending.pop(key, None)
+        self._modified.discard(key)
+
+    def __contains__(self, key):
+        return key in self.index or key in self._pending
 
     def exit(self):
-        for key in self._modified:
+        for key in list(self._modified) + self._pending.keys():
             self.free(key)
+        self.sync()
 
 
-class AllTweets(MultiPkl):
+class AllTweets(TweetArchive):
     def __init__(self, config):
-        """ Open or create the all tweets dict """
-        MultiPkl.__init__(self, config.get('path', 'tweets_dir'))
+        """ Open or create the all tweets archive """
+        TweetArchive.__init__(self, config.get('path', 'tweets_dir'))
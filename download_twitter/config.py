@@ -13,3 +13,20 @@ def get_config():
                  'twitter_image.conf',
                  os.path.expanduser('~/.twitter_image.conf')])
     return config
+
+
+def get_option(config, section, option, default=None):
+    """
+    Get an optional option, `default` is returned when it is not configured
+    and gives the type of the value
+    """
+    if not config.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    if isinstance(default, int):
+        return config.getint(section, option)
+    if isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""
+Links of the medias downloaded today in the daily dir, and its manifest
+"""
+
+import atexit
+import errno
+import json
+import os
+
+
+class DailyLinker(object):
+    """
+    Collect the links to create in the daily dirs during the run and
+    create them at once in `flush` (at the end of the run, or at exit).
+
+    Each daily dir gets a manifest (`MANIFEST`, one json object per line
+    and per link: link, target, list, user, media_id, status_id,
+    created_at) which galleries can read instead of listing the links.
+    """
+    MANIFEST = 'index.jsonl'
+
+    def __init__(self, config):
+        self._image_path = "%s/" % config.get('path',
+                                              'image_path').rstrip('/')
+        self._pending = []
+        self.linked = 0
+        atexit.register(self.flush)
+
+    def add(self, daily, list_name, username, filepath, media_id, status):
+        """ link filepath, the media of status, in the daily dir `daily` """
+        filename = '%s_%s' % (username, os.path.basename(filepath))
+        target = filepath
+        if target.startswith(self._image_path):
+            target = target[len(self._image_path):]
+
+        self._pending.append((daily, filepath, {
+            'link': os.path.join(list_name, filename),
+            'target': target,
+            'list': list_name,
+            'user': username,
+            'media_id': media_id,
+            'status_id': status['id'],
+            'created_at': status['created_at'],
+        }))
+
+    def flush(self):
+        """ create the pending links and write them in the manifests """
+        pending, self._pending = self._pending, []
+
+        manifests = {}
+        for daily, filepath, entry in pending:
+            try:
+                os.symlink(filepath, os.path.join(daily, entry['link']))
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    print "could not link %s (%s)" % (filepath, err)
+                continue
+            manifests.setdefault(daily, []).append(
+                    json.dumps(entry, separators=(',', ':'), sort_keys=True))
+
+        for daily, lines in manifests.items():
+            with open(os.path.join(daily, self.MANIFEST), 'a') as fdesc:
+                fdesc.write('\n'.join(lines) + '\n')
+            self.linked += len(lines)
+
+        return sum([len(lines) for lines in manifests.values()])
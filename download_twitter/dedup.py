@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""
+Downloaded images deduplication, on their content without the exif
+"""
+
+import errno
+import os
+
+from .cache import MediaHashes
+from .config import get_option
+from .exif import payload_hash
+
+
+class Deduplicator(object):
+    """
+    Keep one file per image content: the first file written for a content
+    (hashed without its exif, see `exif.payload_hash`) is the canonical
+    one, the next ones are hard links to it (symbolic links when a hard
+    link is not possible, another filesystem for example). The duplicates
+    show the exif (status text, artist) of the canonical file.
+
+    The hash -> canonical path index is a `MediaHashes` store, fill it for
+    the images downloaded before with bin/dedupe.py.
+    """
+
+    def __init__(self, config):
+        self.enabled = get_option(config, 'dedup', 'enabled', False)
+        self.hashes = MediaHashes(config)
+        self.linked = 0
+
+    def canonical(self, digest, filepath):
+        """ the file already holding this content, None if there is none """
+        canonical = self.hashes.get(digest)
+        if canonical is None or canonical == filepath:
+            return None
+
+        if not os.path.exists(canonical):
+            # removed by hand, the next file takes its place
+            del self.hashes[digest]
+            return None
+        return canonical
+
+    @staticmethod
+    def link(canonical, filepath):
+        """ make filepath a link to canonical, replacing filepath """
+        tmp_filepath = '%s.tmp' % filepath
+        try:
+            os.link(canonical, tmp_filepath)
+        except OSError, err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            os.symlink(os.path.abspath(canonical), tmp_filepath)
+        os.rename(tmp_filepath, filepath)
+
+    def add(self, digest, filepath):
+        """
+        Index filepath as holding `digest`. Return the canonical file if it
+        is a duplicate, None if it is the first one of its kind
+        """
+        canonical = self.canonical(digest, filepath)
+        if canonical is None:
+            self.hashes[digest] = filepath
+        return canonical
+
+    def write(self, filepath, data, write):
+        """
+        Link filepath to the file holding the same image if there is one,
+        otherwise call `write` (which writes data in filepath) and index it.
+        Return True if filepath was linked
+        """
+        if not self.enabled:
+            write()
+            return False
+
+        digest = payload_hash(data)
+        canonical = self.canonical(digest, filepath)
+        if canonical is not None:
+            self.link(canonical, filepath)
+            self.linked += 1
+            return True
+
+        write()
+        self.hashes[digest] = filepath
+        return False
+
+    def stats(self):
+        """ summary of the deduplication """
+        return "duplicates: %d images linked, %d known" % (
+                self.linked, len(self.hashes))
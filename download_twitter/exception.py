@@ -33,6 +33,10 @@ class InternalRateLimit(RateLimit):
     _from_twitter = False
 
 
+class IncompletePagination(Exception):
+    """ a page failed (twitter or connection error), the next ones are missing """
+
+
 def exception_handler(method):
     """ Handle exceptions that could happen here """
 
@@ -44,9 +48,6 @@ def exception_handler(method):
         except ConnectionError, err:
             print "    connection error, %s" % display_method(method, args, kwargs)
         except TwythonRateLimitError, err:
-            if err.error_code == 1337:
-                raise InternalRateLimit()
-
             print err
             print "at %s" % datetime.now()
             raise RateLimit()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""
+Jpeg segments and exif writing without decoding the whole image
+"""
+
+from hashlib import md5
+import struct
+
+
+SOI = '\xff\xd8'
+APP0 = 0xe0
+APP1 = 0xe1
+SOS = 0xda
+EXIF_HEADER = 'Exif\x00\x00'
+
+# markers without length (and without data)
+STANDALONE = set([0x01] + range(0xd0, 0xd8))
+
+# exif tags we write, in the order the IFD needs them
+IMAGE_DESCRIPTION = 0x010e
+DATE_TIME = 0x0132
+ARTIST = 0x013b
+ASCII = 2
+
+
+class InvalidJpeg(Exception):
+    """ the data is not a jpeg we understand """
+
+
+def is_jpeg(data):
+    """ does the data start like a jpeg """
+    return data[:2] == SOI
+
+
+def iter_segments(data):
+    """
+    Yield (marker, start, end) of the segments of a jpeg, up to the start
+    of scan segment (the image data which follows is not segmented).
+    start and end are offsets in data, the marker included.
+    """
+    if not is_jpeg(data):
+        raise InvalidJpeg('no start of image')
+
+    offset = 2
+    size = len(data)
+    while offset < size:
+        if data[offset] != '\xff':
+            raise InvalidJpeg('no marker at %d' % offset)
+
+        # markers can be padded with 0xff
+        while offset + 1 < size and data[offset + 1] == '\xff':
+            offset += 1
+        if offset + 1 >= size:
+            raise InvalidJpeg('truncated marker at %d' % offset)
+        marker = ord(data[offset + 1])
+
+        if marker in STANDALONE:
+            yield marker, offset, offset + 2
+            offset += 2
+            continue
+
+        if offset + 4 > size:
+            raise InvalidJpeg('truncated segment at %d' % offset)
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        yield marker, offset, offset + 2 + length
+
+        if marker == SOS:
+            return
+        offset += 2 + length
+
+
+def is_exif(data, start, marker):
+    """ is the segment at start an exif APP1 """
+    return marker == APP1 and data[start + 4:start + 10] == EXIF_HEADER
+
+
+def ascii_entries(endian, tags, data_offset):
+    """
+    ({tag: IFD entry}, values) of the ascii `tags` ({tag: string}), the
+    values which don't fit in their entry are stored from `data_offset`
+    (an offset in the tiff data)
+    """
+    entries = {}
+    values = []
+    for tag, value in sorted(tags.items()):
+        value = '%s\x00' % value.replace('\x00', '')
+        if len(value) <= 4:
+            entries[tag] = struct.pack(endian + 'HHI4s', tag, ASCII,
+                                       len(value), value)
+            continue
+        entries[tag] = struct.pack(endian + 'HHII', tag, ASCII, len(value),
+                                   data_offset)
+        values.append(value)
+        data_offset += len(value)
+        if data_offset % 2:
+            # values start on a word boundary
+            values.append('\x00')
+            data_offset += 1
+    return entries, ''.join(values)
+
+
+def ifd(endian, entries, next_ifd):
+    """ an IFD of the `entries` ({tag: IFD entry}), sorted by tag """
+    return ''.join([struct.pack(endian + 'H', len(entries))] +
+                   [entries[tag] for tag in sorted(entries)] + [next_ifd])
+
+
+def app1(tiff):
+    """ the APP1 exif segment of the `tiff` data """
+    payload = EXIF_HEADER + tiff
+    if len(payload) + 2 > 0xffff:
+        raise InvalidJpeg('exif too big')
+    return ''.join(['\xff\xe1', struct.pack('>H', len(payload) + 2), payload])
+
+
+def exif_segment(tags):
+    """
+    An APP1 exif segment holding the `tags` ({tag: ascii string}) in its
+    first IFD, big endian.
+    """
+    entries, values = ascii_entries('>', tags, 8 + 2 + 12 * len(tags) + 4)
+    return app1(''.join(['MM\x00\x2a', struct.pack('>I', 8),
+                         ifd('>', entries, struct.pack('>I', 0)), values]))
+
+
+def updated_exif_segment(data, start, end, tags, keep=()):
+    """
+    The exif segment of data (from start to end) with the `tags` in its
+    first IFD, the ones of `keep` only if it does not have them. The new
+    IFD and its values are appended to the tiff data, everything else
+    (sub IFDs, maker notes, thumbnail) stays at its offset.
+    """
+    tiff = data[start + 10:end]
+    endian = {'II': '<', 'MM': '>'}.get(tiff[:2])
+    if endian is None or len(tiff) < 8 or struct.unpack(
+            endian + 'H', tiff[2:4])[0] != 42:
+        raise InvalidJpeg('bad tiff header')
+
+    offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if offset + 2 > len(tiff):
+        raise InvalidJpeg('first IFD out of the exif')
+    count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+    next_offset = offset + 2 + 12 * count
+    if next_offset + 4 > len(tiff):
+        raise InvalidJpeg('first IFD out of the exif')
+
+    entries = {}
+    for position in range(offset + 2, next_offset, 12):
+        entry = tiff[position:position + 12]
+        entries[struct.unpack(endian + 'H', entry[:2])[0]] = entry
+    tags = dict([(tag, value) for tag, value in tags.items()
+                 if tag not in keep or tag not in entries])
+
+    # the new IFD starts on a word boundary after the tiff data
+    padding = '\x00' * (len(tiff) % 2)
+    new_offset = len(tiff) + len(padding)
+    size = 2 + 12 * len(set(entries) | set(tags)) + 4
+    new_entries, values = ascii_entries(endian, tags, new_offset + size)
+    entries.update(new_entries)
+
+    return app1(''.join([tiff[:4], struct.pack(endian + 'I', new_offset),
+                         tiff[8:], padding,
+                         ifd(endian, entries,
+                             tiff[next_offset:next_offset + 4]),
+                         values]))
+
+
+def write_with_exif(fdesc, data, tags, keep=()):
+    """
+    Write the jpeg `data` in fdesc with an exif segment holding `tags`:
+    the exif segment of the jpeg is updated (see `updated_exif_segment`),
+    a new one is inserted after the APP0 (JFIF) segments when it has
+    none. The image data is not copied, it is streamed through a
+    memoryview.
+    """
+    position = 2
+    leading = True
+    for marker, start, end in iter_segments(data):
+        if is_exif(data, start, marker):
+            segment = updated_exif_segment(data, start, end, tags, keep)
+            view = memoryview(data)
+            fdesc.write(view[:start])
+            fdesc.write(segment)
+            fdesc.write(view[end:])
+            return
+        if leading and marker == APP0:
+            position = end
+        else:
+            leading = False
+
+    segment = exif_segment(tags)
+    view = memoryview(data)
+    fdesc.write(view[:position])
+    fdesc.write(segment)
+    fdesc.write(view[position:])
+
+
+def payload_hash(data):
+    """
+    md5 of the image without its exif segments, the same for a downloaded
+    image and the file we wrote with its exif (or another status text).
+    Data which is not a jpeg is hashed whole. data can be a string or a
+    mmap, it is hashed through buffers, never copied.
+    """
+    digest = md5()
+    position = 0
+    try:
+        if is_jpeg(data):
+            for marker, start, end in iter_segments(data):
+                if is_exif(data, start, marker):
+                    digest.update(buffer(data, position, start - position))
+                    position = end
+    except InvalidJpeg:
+        digest = md5()
+        position = 0
+
+    digest.update(buffer(data, position))
+    return digest.hexdigest()
@@ -6,17 +6,45 @@ Image module
 import pexif
 from pexif import JpegFile
 
-from .utils import sanitize, is_retweet, get_images_from_status
-
+from . import exif
+from .config import get_option
+from .scanner import hash_file
+from .utils import (sanitize, is_retweet, get_images_from_status,
+                    get_video_links, get_host, classify_status, VIDEO,
+                    VIDEO_HOSTS)
+
+import errno
 import os
 from datetime import datetime
-from distutils.dir_util import mkpath
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from vine_dwl import VineDwl
-from hashlib import md5
-import urllib2
-from urllib2 import HTTPError, URLError
-from httplib import BadStatusLine
-import socket
+
+
+# directories known to exist, for all the factories of the process, until
+# `forget_dirs`
+CREATED_DIRS = set()
+
+
+def ensure_dir(path):
+    """ create path if needed, the file system is asked once per path """
+    if path in CREATED_DIRS:
+        return
+    # not distutils mkpath, it never asks twice for a path in the process
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+    CREATED_DIRS.add(path)
+
+
+def forget_dirs():
+    """
+    ask the file system again for the directories (a long running process
+    does it on each run, a directory removed by hand is created again)
+    """
+    CREATED_DIRS.clear()
 
 
 class Image(object):
@@ -62,15 +90,47 @@ class Image(object):
         if not self.img.exif.primary.has_key('DateTime'):
             self.img.exif.primary.DateTime = self.created_at
 
+    @property
+    def tags(self):
+        """ the exif tags we put in a jpeg (see `write`) """
+        return {
+            exif.IMAGE_DESCRIPTION: self.text,
+            exif.ARTIST: self.name,
+            exif.DATE_TIME: self.created_at,
+        }
+
+    def _write_raw(self):
+        with open(self.filepath, 'wb') as fdesc:
+            fdesc.write(self.data)
+
     def write(self):
-        """ write image data and exif when possible """
+        """
+        write image data and exif when possible
+
+        The exif segment of a jpeg is updated (or inserted) as it is, the
+        image data is streamed as is: the description is replaced, the
+        artist and date kept when the jpeg has them. Exif we can't update
+        this way go through pexif, other formats (png, gif...) are written
+        as they are.
+        """
+        if not exif.is_jpeg(self.data):
+            self._write_raw()
+            return
+
+        try:
+            with open(self.filepath, 'wb') as fdesc:
+                exif.write_with_exif(fdesc, self.data, self.tags,
+                                     keep=(exif.ARTIST, exif.DATE_TIME))
+            return
+        except exif.InvalidJpeg:
+            pass
+
         try:
             self._put_exif()
             self.img.writeFile(self.filepath)
-        except JpegFile.InvalidFile:
+        except (exif.InvalidJpeg, JpegFile.InvalidFile):
             print "      could not put exif in %s" % self.media_id
-            with open(self.filepath, 'wb') as fdesc:
-                fdesc.write(self.data)
+            self._write_raw()
 
 
 class ImageMd5(object):
@@ -78,15 +138,9 @@ class ImageMd5(object):
         self._path = path
 
     def md5sum(self):
-        read_data = None
-        with open(self._path, 'r') as filehandle:
-            read_data = filehandle.read()
-
-        img = pexif.JpegFile.fromString(read_data)
-        img.exif.primary.Artist = ''
-        img.exif.primary.DateTimeOriginal = ''
-
-        return md5(img.writeString()).hexdigest().upper()
+        """ md5 of the image without its exif (see `scanner.hash_file`) """
+        digest = hash_file(self._path)
+        return digest.upper() if digest is not None else None
 
 
 class MediaFactory(object):
@@ -94,66 +148,62 @@ class MediaFactory(object):
 
     def __init__(self, api, config, listname, username):
         self._api = api
+        self._config = config
         self._image_path = "%s/" % config.get('path', 'image_path').rstrip('/')
 
-        self._daily_path = "%s/" % config.get('path', 'daily_path').rstrip('/')
-
+        self._listname = listname
+        self._username = username
         self.path = os.path.join(self._image_path, listname, username)
-        self._daily = '%s%s/' % (self._daily_path,
-            datetime.now().strftime('%Y%m%d'))
 
         self._retweet = 'retweet'
+        self._concurrency = max(
+            get_option(config, 'download', 'concurrency', 1), 1)
+        self._resolver = api.resolver
+        self._dedup = api.dedup
+        self._media_index = api.media_index
+        self._linker = api.daily
+
+    def should_get_media(self, _url, filepath):
+        """
+        Should we get this image demending on several considerations
+        (is the file in the `MediaIndex` only right now)
+        """
+        return filepath not in self._media_index
 
     @staticmethod
-    def should_get_media(_url, filepath):
+    def daily_dir(config):
+        """ the daily dir of today """
+        return '%s/%s/' % (config.get('path', 'daily_path').rstrip('/'),
+                           datetime.now().strftime('%Y%m%d'))
+
+    @classmethod
+    def prepare_daily(cls, config, list_names):
         """
-        Should we get this image demending on several considerations
-        (does the file exists only right now)
+        Create the daily dir of today and its dir per list (at the start of
+        the run or when a link is added after midnight or for a new list)
+        and return it
         """
-        return not os.path.exists(filepath)
+        daily = cls.daily_dir(config)
+        ensure_dir(daily)
+        for group_name in list_names:
+            ensure_dir(os.path.join(daily, group_name))
+        return daily
 
     def prepare_dir(self, filepath):
         """
         Prepare what we are going to need on the file system for the next step
         """
-        mkpath(os.path.dirname(filepath))
-
-        if not os.path.exists(self._daily):
-            mkpath(self._daily)
-
-        for group_name in self._api.listcontent['list_content']:
-            path = os.path.join(self._daily, group_name)
-            if not os.path.exists(path):
-                mkpath(path)
-
-    def link_daily(self, filepath):
-        """ Create a link between the newly download file and daily dir """
-        directory = os.path.dirname(filepath)
-        first_level = os.path.basename(directory)
+        ensure_dir(os.path.dirname(filepath))
 
-        shift_dir = os.path.dirname(directory)
-        second_level = os.path.basename(shift_dir)
-        third_level = os.path.basename(os.path.dirname(shift_dir))
-        retweet = first_level == self._retweet
-
-        if retweet:
-            first_level = second_level
-            second_level = third_level
-
-        list_name = second_level
-        if second_level == os.path.basename(self._image_path.rstrip('/')):
-            list_name = ''
-
-        try:
-            link = os.path.join(self._daily,
-                                list_name,
-                                '%s_%s' % (
-                                    os.path.basename(directory),
-                                    os.path.basename(filepath),
-                                ))
-            os.symlink(filepath, link)
-        except OSError:
-            pass
+    def link_daily(self, filepath, media_id, status):
+        """
+        Link the newly downloaded file in the daily dir, the links are
+        created at the end of the run (see `DailyLinker`)
+        """
+        daily = self.prepare_daily(self._config,
+                                   self._api.listcontent['list_content'])
+        self._linker.add(daily, self._listname, self._username,
+                         filepath, media_id, status)
 
     OK = 0
     RETWEET = 1
@@ -161,69 +211,117 @@ class MediaFactory(object):
     EXISTS = 3
     RETWEET_EXISTS = 4
 
-    def retrieve_image(self, media_id, media_url, status):
-        """ Retrieve the image """
+    def image_filepath(self, media_id, status):
+        """ Where the image `media_id` of this status is stored """
         retweet = self._retweet if is_retweet(status) else ''
-        filepath = os.path.join(self.path, retweet, media_id + '.jpg')
-        if not self.should_get_media(media_url, filepath):
-            return self.RETWEET_EXISTS if retweet else self.EXISTS
+        return os.path.join(self.path, retweet, media_id + '.jpg')
 
-        data = self._api.get_image(media_url)
+    def store_image(self, media_id, filepath, data, status):
+        """
+        Write downloaded image data on disk (or link it to the same image
+        downloaded before) and link it in the daily dir
+        """
         if not data:
             return self.EMPTY
 
         self.prepare_dir(filepath)
-        Image(media_id, filepath, data, status).write()
-        self.link_daily(filepath)
-        return self.RETWEET if retweet else self.OK
+        self._dedup.write(filepath, data,
+                          Image(media_id, filepath, data, status).write)
+        self._media_index.add(filepath)
+        self.link_daily(filepath, media_id, status)
+        return self.RETWEET if is_retweet(status) else self.OK
 
-    def get_vine_link(self, status):
-        urls = [word for word in status['text'].split(' ')
-                     if word.startswith('http')
-                         and '://' in word]
+    def retrieve_image(self, media_id, media_url, status):
+        """ Retrieve the image """
+        filepath = self.image_filepath(media_id, status)
+        if not self.should_get_media(media_url, filepath):
+            return self.RETWEET_EXISTS if is_retweet(status) else self.EXISTS
 
-        ret = []
-        for url in urls:
-            # right now t.co urls are 22 long
-            if url.startswith('https://'):
-                url = url[0:23]
-            else:
-                url = url[0:22]
+        data = self._api.get_image(media_url)
+        return self.store_image(media_id, filepath, data, status)
 
-            try:
-                request = urllib2.urlopen(url)
-            except UnicodeEncodeError:
-                continue
-            except (HTTPError, URLError, ValueError, BadStatusLine), err:
-                try:
-                    if hasattr(err, 'code'):
-                        print (err.code, err, url)
-                    else:
-                        print (err, url)
-                except:
-                    pass
-                continue
-            except socket.error:
-                continue
-
-            if 'vine.co' in request.url:
-                ret.append(request.url)
-
-        return ret
-
-    def retrieve_video(self, status):
-        """ Retrieve a video from a vine link """
+    def image_jobs(self, statuses):
+        """
+        Expand the statuses in a list of images to download
+        (media_id, media_url, status, filepath) and a list of states for the
+        images we already have
+        """
+        jobs = []
+        states = []
+        seen = set()
+        for status in statuses:
+            for media_id, media_url in get_images_from_status(status):
+                filepath = self.image_filepath(media_id, status)
+                if filepath in seen or not self.should_get_media(media_url,
+                                                                 filepath):
+                    states.append(self.RETWEET_EXISTS if is_retweet(status)
+                                  else self.EXISTS)
+                    continue
+
+                seen.add(filepath)
+                jobs.append((media_id, media_url, status, filepath))
+        return jobs, states
+
+    def _fetch(self, job):
+        """ download stage, run in the worker threads """
+        return self._api.get_image(job[1])
+
+    def retrieve_images(self, statuses):
+        """
+        Download all the images of the statuses with `concurrency` workers,
+        data is written on disk by the calling thread as it arrives.
+        Return the state of each image.
+        """
+        jobs, states = self.image_jobs(statuses)
+
+        if self._concurrency == 1 or len(jobs) < 2:
+            datas = (self._fetch(job) for job in jobs)
+            pool = None
+        else:
+            pool = ThreadPool(min(self._concurrency, len(jobs)))
+            datas = pool.imap(self._fetch, jobs)
+
+        try:
+            for (media_id, _, status, filepath), data in izip(jobs, datas):
+                states.append(
+                        self.store_image(media_id, filepath, data, status))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return states
+
+    def get_vine_link(self, status, resolved=None):
+        """
+        The vine links of a status, `resolved` are the short links already
+        resolved by `LinkResolver.resolve_all`
+        """
+        videos, to_resolve = get_video_links(status)
+        if resolved is None:
+            resolved = self._resolver.resolve_all(to_resolve)
+
+        return videos + [resolved[url] for url in to_resolve
+                         if resolved.get(url)
+                            and get_host(resolved[url]) in VIDEO_HOSTS]
+
+    def video_filepath(self, status):
+        """ Where the video of this status is stored """
         retweet = self._retweet if is_retweet(status) else ''
-        filepath = os.path.join(self.path, retweet, str(status['id']) + '.mp4')
+        return os.path.join(self.path, retweet, str(status['id']) + '.mp4')
+
+    def retrieve_video(self, status, resolved=None):
+        """ Retrieve a video from a vine link """
+        filepath = self.video_filepath(status)
 
         if not self.should_get_media(None, filepath):
-            return self.RETWEET_EXISTS if retweet else self.EXISTS
+            return self.RETWEET_EXISTS if is_retweet(status) else self.EXISTS
 
-        self.prepare_dir(filepath)
-        urls = self.get_vine_link(status)
+        urls = self.get_vine_link(status, resolved)
         if not urls:
             return self.EMPTY
 
+        self.prepare_dir(filepath)
         for url in urls:
             vine = VineDwl(url)
             # TODO if more than one, change the name!
@@ -233,23 +331,41 @@ class MediaFactory(object):
                 print ('Error in vine retrieve for %s (%s)' %
                        (url, err))
 
-        return self.RETWEET if retweet else self.OK
+        if not os.path.exists(filepath):
+            # none of the links gave a video
+            return self.EMPTY
+        self._media_index.add(filepath)
+        return self.RETWEET if is_retweet(status) else self.OK
+
+    def resolve_links(self, statuses):
+        """ resolve at once the short links of the statuses without video """
+        return self._resolver.resolve_all([
+                url for status in statuses
+                if self.should_get_media(None, self.video_filepath(status))
+                for url in get_video_links(status)[1]])
 
     def retrieve_all(self, statuses):
-        """ loop over all the statuses and call `retrieve_image` on each """
+        """
+        Retrieve all the images (see `retrieve_images`) and videos of
+        the statuses
+        """
         pic_nb = 0
         retweet_nb = 0
         video_nb = 0
         video_retweet_nb = 0
-        for status in statuses:
-            for media_id, media_url in get_images_from_status(status):
-                state = self.retrieve_image(media_id, media_url, status)
-                if state in (self.OK, self.RETWEET):
-                    pic_nb += 1
-                if state in (self.RETWEET, ):
-                    retweet_nb += 1
 
-            state = self.retrieve_video(status)
+        for state in self.retrieve_images(statuses):
+            if state in (self.OK, self.RETWEET):
+                pic_nb += 1
+            if state in (self.RETWEET, ):
+                retweet_nb += 1
+
+        # only the statuses with a link to a video (host) are worth it
+        candidates = [status for status in statuses
+                      if VIDEO in classify_status(status)]
+        resolved = self.resolve_links(candidates)
+        for status in candidates:
+            state = self.retrieve_video(status, resolved)
             if state in (self.OK, self.RETWEET):
                 video_nb += 1
             if state in (self.RETWEET, ):
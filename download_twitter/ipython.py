@@ -40,38 +40,36 @@ def getDeletedFriends():
 
 def refreshFriendList():
     friends = getFriendList()
-    for key, value in api.get_friends():
+    for key, value in api.iter_friends(checkpoint='friends'):
         friends[key] = value
 
 
 def refreshListContent():
-    listcontent = getListContent()
-    for key, value in api.retrieve_list_content().items():
-        listcontent[key] = value
+    getListContent().refresh(api.retrieve_list_content())
 
 
 def rmList(user_name):
-    rss_id, _list_name = api.get_list(list_name='Rss')
-    rss = dict(api.get_list_users(rss_id))
+    friend_id, friend_name = api.get_friend(user_name=user_name)
 
-    person_id, _list_name = api.get_list(list_name='Person')
-    person = dict(api.get_list_users(person_id))
+    list_name = getListContent().get('friend_in_list', {}).get(friend_id)
+    if list_name is None:
+        for name in ('Rss', 'Person'):
+            if api.is_in_list(name, friend_id):
+                list_name = name
+                break
 
-    friend_id, friend_name = api.get_friend(user_name=user_name)
-    if friend_id in rss:
-        api.del_user_from_list('Rss', friend_name)
-    elif friend_id in person:
-        api.del_user_from_list('Person', friend_name)
+    if list_name:
+        api.del_user_from_list(list_name, friend_name)
     else:
         print "%s is not in a list" % user_name
 
 
-def setRss(user_name):
-    return api.put_user_in_list('Rss', user_name)
+def setRss(*user_names):
+    return api.put_users_in_list('Rss', user_names)
 
 
-def setPerson(user_name):
-    return api.put_user_in_list('Person', user_name)
+def setPerson(*user_names):
+    return api.put_users_in_list('Person', user_names)
 
 
 def info(user_name):
@@ -79,14 +77,4 @@ def info(user_name):
 
 
 def show_ratelimit():
-    ratelimit = getRatelimit()
-    dft_ratelimit = dict([(k, int(v))for k, v in CONFIG.items('ratelimit')])
-
-    ret = {}
-    now = api.twitter.now()
-    for url, limit in dft_ratelimit.items():
-        total = 0
-        for date in range(now - 16, now):
-            total += ratelimit[url].get(date, 0)
-        ret[url] = [limit, total]
-    return ret
+    return api.twitter.limiter.usage()
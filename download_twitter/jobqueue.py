@@ -0,0 +1,267 @@
+#!/usr/bin/python
+"""
+Queue of jobs shared by a coordinator and workers on several hosts (see
+bin/coordinator.py and bin/worker.py), in a sqlite database on a shared
+file system
+
+The writers are kept apart by the sqlite file locks (rollback journal,
+each write in a BEGIN IMMEDIATE transaction): the shared file system must
+implement the POSIX (fcntl) locks across hosts, as NFS with a working lock
+daemon (lockd) does. A file system without them (most SMB/CIFS mounts,
+NFS mounted with nolock, sshfs) corrupts the database, keep it on a local
+disk and run the workers on that host then.
+"""
+
+import cPickle as pickle
+import os
+import sqlite3
+import threading
+import time
+
+from .config import get_option
+
+
+# kinds of jobs
+TIMELINE = 'timeline'
+MEDIA = 'media'
+VIDEO = 'video'
+
+# states of a job
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+COLLECTED = 'collected'
+# failed and collected
+DROPPED = 'dropped'
+
+
+def job_key(kind, *parts):
+    """ the key of a job, a job is queued once per key """
+    return ':'.join([kind] + [str(part) for part in parts])
+
+
+class JobQueue(object):
+    """
+    Jobs (kind, key, payload) leased by the workers for `lease` seconds: a
+    job whose worker died before completing it is leased again once its
+    lease expires, and fails after `max_attempts` leases. The results of
+    the done jobs, and the failed jobs, are collected by the coordinator.
+
+    A key is queued once: putting it again does nothing until the job is
+    collected, and then only with `renew` (`retry_after` seconds after its
+    failure for a failed job).
+    """
+
+    def __init__(self, config):
+        self.path = get_option(config, 'queue', 'database', os.path.join(
+                config.get('path', 'data_dir'), 'queue.db'))
+        self.lease_time = get_option(config, 'queue', 'lease', 300)
+        self.max_attempts = get_option(config, 'queue', 'max_attempts', 5)
+        self.retry_after = get_option(config, 'queue', 'retry_after',
+                                      6 * 3600)
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        # not WAL: its shared memory index does not work across hosts
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'key TEXT PRIMARY KEY, kind TEXT, payload BLOB, '
+                         'state TEXT, attempts INTEGER, lease_until REAL, '
+                         'worker TEXT, result BLOB, created REAL, '
+                         'updated REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_state '
+                         'ON jobs (state, kind)')
+
+    def _transaction(self, queries):
+        """ run queries(db) in a write transaction, return its value """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                ret = queries(self._db)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return ret
+
+    def put(self, kind, key, payload, renew=False):
+        """
+        Queue a job, True if it was. With `renew`, a job collected (failed
+        `retry_after` seconds ago if it failed) is queued again with the
+        new payload
+        """
+        return bool(self.put_many(kind, [(key, payload)], renew))
+
+    def put_many(self, kind, jobs, renew=False):
+        """
+        `put` the jobs [(key, payload), ...] in one transaction, return
+        how many were queued
+        """
+        now = time.time()
+        jobs = [(key, sqlite3.Binary(pickle.dumps(payload,
+                                                  pickle.HIGHEST_PROTOCOL)))
+                for key, payload in jobs]
+
+        def queries(db):
+            queued = 0
+            for key, data in jobs:
+                cursor = db.execute(
+                        'INSERT OR IGNORE INTO jobs (key, kind, payload, '
+                        'state, attempts, lease_until, created, updated) '
+                        'VALUES (?, ?, ?, ?, 0, 0, ?, ?)',
+                        (key, kind, data, PENDING, now, now))
+                if not cursor.rowcount and renew:
+                    cursor = db.execute(
+                            'UPDATE jobs SET payload = ?, state = ?, '
+                            'attempts = 0, lease_until = 0, worker = NULL, '
+                            'result = NULL, updated = ? WHERE key = ? AND '
+                            '(state = ? OR (state = ? AND updated < ?))',
+                            (data, PENDING, now, key, COLLECTED, DROPPED,
+                             now - self.retry_after))
+                queued += cursor.rowcount
+            return queued
+        return self._transaction(queries)
+
+    def queued(self, kind):
+        """ the keys of `kind` a `put` (with `renew`) leaves alone """
+        with self._lock:
+            return set([key for key, in self._db.execute(
+                    'SELECT key FROM jobs WHERE kind = ? AND state != ? '
+                    'AND NOT (state = ? AND updated < ?)',
+                    (kind, COLLECTED, DROPPED,
+                     time.time() - self.retry_after))])
+
+    def lease(self, worker, count=1, kinds=None):
+        """
+        Lease up to `count` jobs (of `kinds`) to `worker`: the jobs pending
+        and the ones whose lease expired. Return [(kind, key, payload), ...]
+        """
+        now = time.time()
+        kinds = kinds or (TIMELINE, MEDIA, VIDEO)
+
+        def queries(db):
+            rows = db.execute(
+                    'SELECT key, kind, payload, state, attempts FROM jobs '
+                    'WHERE state IN (?, ?) AND lease_until <= ? '
+                    'AND kind IN (%s) ORDER BY lease_until, created '
+                    'LIMIT ?' % ', '.join('?' * len(kinds)),
+                    (PENDING, LEASED, now) + tuple(kinds) + (count, )
+                    ).fetchall()
+
+            jobs = []
+            for key, kind, payload, state, attempts in rows:
+                if state == LEASED and attempts >= self.max_attempts:
+                    # its workers died on it each time
+                    db.execute('UPDATE jobs SET state = ?, worker = NULL, '
+                               'updated = ? WHERE key = ?',
+                               (FAILED, now, key))
+                    continue
+                db.execute('UPDATE jobs SET state = ?, worker = ?, '
+                           'attempts = attempts + 1, lease_until = ?, '
+                           'updated = ? WHERE key = ?',
+                           (LEASED, worker, now + self.lease_time, now, key))
+                jobs.append((kind, key, pickle.loads(str(payload))))
+            return jobs
+        return self._transaction(queries)
+
+    def _leased(self, db, key, worker, update, values):
+        """ apply update to the job if worker still holds its lease """
+        cursor = db.execute(
+                'UPDATE jobs SET %s, updated = ? WHERE key = ? '
+                'AND state = ? AND worker = ?' % update,
+                tuple(values) + (time.time(), key, LEASED, worker))
+        return bool(cursor.rowcount)
+
+    def complete(self, key, worker, result=None):
+        """
+        The job is done, False if its lease expired meanwhile (another
+        worker may have it now)
+        """
+        data = sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        return self._transaction(lambda db: self._leased(
+                db, key, worker, 'state = ?, result = ?', (DONE, data)))
+
+    def fail(self, key, worker, error):
+        """
+        The job failed, it is tried again later (the more attempts, the
+        later) until `max_attempts`
+        """
+        now = time.time()
+
+        def queries(db):
+            row = db.execute('SELECT attempts FROM jobs WHERE key = ?',
+                             (key, )).fetchone()
+            if row is None:
+                return False
+            if row[0] >= self.max_attempts:
+                return self._leased(db, key, worker, 'state = ?, result = ?',
+                                    (FAILED, str(error)))
+            return self._leased(db, key, worker,
+                                'state = ?, lease_until = ?, result = ?',
+                                (PENDING, now + 60 * 2 ** row[0],
+                                 str(error)))
+        return self._transaction(queries)
+
+    def release(self, key, worker, until=0):
+        """
+        Give the job back without counting the attempt (we were
+        ratelimited), it can't be leased before `until`
+        """
+        return self._transaction(lambda db: self._leased(
+                db, key, worker,
+                'state = ?, attempts = attempts - 1, lease_until = ?',
+                (PENDING, until)))
+
+    def collect(self, kind, limit=1000):
+        """
+        [(key, payload, result), ...] of the done jobs of `kind`, they are
+        not returned again
+        """
+        def queries(db):
+            rows = db.execute('SELECT key, payload, result FROM jobs '
+                              'WHERE kind = ? AND state = ? LIMIT ?',
+                              (kind, DONE, limit)).fetchall()
+            db.executemany('UPDATE jobs SET state = ?, result = NULL '
+                           'WHERE key = ?',
+                           [(COLLECTED, row[0]) for row in rows])
+            return [(key, pickle.loads(str(payload)),
+                     pickle.loads(str(result)))
+                    for key, payload, result in rows]
+        return self._transaction(queries)
+
+    def collect_failed(self, kind, limit=1000):
+        """
+        [(key, payload, error), ...] of the jobs of `kind` which failed
+        `max_attempts` times, they are not returned again
+        """
+        now = time.time()
+
+        def queries(db):
+            rows = db.execute('SELECT key, payload, result FROM jobs '
+                              'WHERE kind = ? AND state = ? LIMIT ?',
+                              (kind, FAILED, limit)).fetchall()
+            db.executemany('UPDATE jobs SET state = ?, updated = ? '
+                           'WHERE key = ?',
+                           [(DROPPED, now, row[0]) for row in rows])
+            return [(key, pickle.loads(str(payload)), error)
+                    for key, payload, error in rows]
+        return self._transaction(queries)
+
+    def purge(self, older=7 * 24 * 3600):
+        """ forget the jobs collected or failed `older` seconds ago """
+        return self._transaction(lambda db: db.execute(
+                'DELETE FROM jobs WHERE state IN (?, ?, ?) AND updated < ?',
+                (COLLECTED, FAILED, DROPPED, time.time() - older)).rowcount)
+
+    def stats(self):
+        """ {kind: {state: count}} """
+        stats = {}
+        with self._lock:
+            for kind, state, count in self._db.execute(
+                    'SELECT kind, state, COUNT(*) FROM jobs '
+                    'GROUP BY kind, state'):
+                stats.setdefault(kind, {})[state] = count
+        return stats
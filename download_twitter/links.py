@@ -0,0 +1,213 @@
+#!/usr/bin/python
+"""
+Short links (t.co, ...) resolution
+"""
+
+from collections import OrderedDict
+import httplib
+from multiprocessing.pool import ThreadPool
+import socket
+import threading
+import time
+import urlparse
+
+from .cache import LinkStore
+from .config import get_option
+
+
+# error classes of a failed resolution
+HTTP_ERROR = 'http'
+URL_ERROR = 'url'
+SOCKET_ERROR = 'socket'
+
+
+class LinkCache(object):
+    """
+    short link -> resolved link, persisted in a `LinkStore` with a LRU of
+    `lru_size` entries in front of it.
+
+    Resolved links are kept `ttl` seconds. Failures are kept too (negative
+    entries), for a time depending on the error class and doubled on each
+    new failure of the same link. `sync` prunes the expired entries, the
+    negative ones `MAX_BACKOFF` after they expired (their failure count
+    still doubles the next backoff until then).
+    """
+    DAY = 24 * 3600
+    BACKOFF = {
+        HTTP_ERROR: DAY,        # the link is dead, or the host refuses us
+        URL_ERROR: 6 * 3600,    # bad url or broken http answer
+        SOCKET_ERROR: 900,      # timeout, refused connection, dns
+    }
+    MAX_BACKOFF = 7 * DAY
+
+    def __init__(self, config):
+        self._store = LinkStore(config)
+        self._ttl = get_option(config, 'links', 'ttl', 30 * self.DAY)
+        self._lru_size = get_option(config, 'links', 'lru_size', 10000)
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def _get_entry(self, url):
+        """ (resolved, expires, error, failures) of url, from LRU or store """
+        if url in self._lru:
+            entry = self._lru.pop(url)
+        else:
+            entry = self._store.get(url)
+            if entry is None:
+                return None
+        self._remember(url, entry)
+        return entry
+
+    def _remember(self, url, entry):
+        self._lru[url] = entry
+        while len(self._lru) > self._lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, url):
+        """
+        (True, resolved) if url is in the cache and not expired, resolved
+        is None for a negative entry, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._get_entry(url)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return False, None
+
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def put(self, url, resolved, error=None):
+        """ cache a resolution, or its failure (`error` class) """
+        with self._lock:
+            if error is None:
+                entry = (resolved, time.time() + self._ttl, None, 0)
+            else:
+                previous = self._get_entry(url)
+                failures = previous[3] + 1 if previous and previous[2] else 1
+                backoff = min(self.BACKOFF[error] * 2 ** (failures - 1),
+                              self.MAX_BACKOFF)
+                entry = (None, time.time() + backoff, error, failures)
+
+            self._store[url] = entry
+            self._remember(url, entry)
+
+    def prune(self, now=None):
+        """ forget the expired entries, return how many """
+        now = time.time() if now is None else now
+        expired = [url for url, entry in self._store.items()
+                   if entry[1] < (now if entry[2] is None
+                                  else now - self.MAX_BACKOFF)]
+        for url in expired:
+            del self._store[url]
+            self._lru.pop(url, None)
+        return len(expired)
+
+    def sync(self):
+        """ prune the cache and make sure the resolutions are on disk """
+        with self._lock:
+            self.prune()
+            self._store.sync()
+
+    def stats(self):
+        """ summary of the cache use """
+        total = self.hits + self.negative_hits + self.misses
+        return ("short links: %d hits, %d negative hits, %d misses "
+                "(%d%% hit rate)" % (
+                self.hits, self.negative_hits, self.misses,
+                100 * (self.hits + self.negative_hits) / total if total else 0))
+
+
+class LinkResolver(object):
+    """
+    Resolve short links with a HEAD request, only the first redirection is
+    followed. Links are resolved in parallel by batches, with at most
+    `concurrency` requests at a time, each limited to `timeout` seconds.
+    The `LinkCache` is asked first.
+    """
+
+    def __init__(self, config):
+        self._timeout = get_option(config, 'links', 'timeout', 5.0)
+        self._concurrency = max(
+            get_option(config, 'links', 'concurrency', 8), 1)
+        self.cache = LinkCache(config)
+
+    def resolve(self, url):
+        """
+        Where the short link `url` leads, `url` itself if it does not
+        redirect, None if it could not be resolved
+        """
+        return self.resolve_all([url])[url]
+
+    def _resolve(self, url):
+        """ (resolved url, None) or (None, error class) """
+        try:
+            parsed = urlparse.urlsplit(url.encode('ascii'))
+        except (UnicodeError, ValueError):
+            return None, URL_ERROR
+
+        if parsed.scheme == 'https':
+            connection = httplib.HTTPSConnection(parsed.netloc,
+                                                 timeout=self._timeout)
+        else:
+            connection = httplib.HTTPConnection(parsed.netloc,
+                                                timeout=self._timeout)
+
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+
+        try:
+            connection.request('HEAD', path)
+            response = connection.getresponse()
+        except socket.error, err:
+            print (err, url)
+            return None, SOCKET_ERROR
+        except (httplib.HTTPException, ValueError), err:
+            print (err, url)
+            return None, URL_ERROR
+        finally:
+            connection.close()
+
+        if 300 <= response.status < 400:
+            location = response.getheader('location')
+            if not location:
+                print (response.status, 'without location', url)
+                return None, URL_ERROR
+            return location, None
+        if response.status >= 400:
+            print (response.status, response.reason, url)
+            return None, HTTP_ERROR
+        return url, None
+
+    def resolve_all(self, urls):
+        """ {url: resolved url or None} for all the urls, in one go """
+        resolved = {}
+        missing = []
+        for url in set(urls):
+            cached, value = self.cache.get(url)
+            if cached:
+                resolved[url] = value
+            else:
+                missing.append(url)
+
+        if len(missing) < 2 or self._concurrency == 1:
+            results = [self._resolve(url) for url in missing]
+        else:
+            pool = ThreadPool(min(self._concurrency, len(missing)))
+            try:
+                results = pool.map(self._resolve, missing)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for url, (value, error) in zip(missing, results):
+            self.cache.put(url, value, error)
+            resolved[url] = value
+        return resolved
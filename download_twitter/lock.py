@@ -0,0 +1,37 @@
+#!/usr/bin/python
+"""
+The lock of the processes which write the stores: the cron runs
+(bin/download_image.py), bin/daemon.py and bin/coordinator.py, one of them
+at a time
+"""
+
+import errno
+import fcntl
+import os
+
+from .config import get_option
+
+
+def lock_path(config):
+    """ the lock file, lock_file of the path section """
+    return get_option(config, 'path', 'lock_file', '/tmp/download_image.lock')
+
+
+def lock_pidfile(pidfile):
+    """
+    Lock pidfile and write our pid in it, the lock goes with the process
+    (even when it crashes). None if another process holds it
+    """
+    fdesc = open(pidfile, 'a+')
+    try:
+        fcntl.flock(fdesc.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, err:
+        fdesc.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+
+    fdesc.truncate(0)
+    fdesc.write('%d\n' % os.getpid())
+    fdesc.flush()
+    return fdesc
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""
+Index of the medias already downloaded, to avoid a stat per media
+"""
+
+from array import array
+import atexit
+from bisect import bisect_left
+from hashlib import md5
+import os
+
+from .config import get_option
+from .scanner import list_files
+
+
+# keys are the first bytes of the md5 of the path, as many as an unsigned
+# long holds (8 on 64 bits)
+KEY_SIZE = array('L').itemsize
+
+
+class MediaIndex(object):
+    """
+    The files of image_path (images `<media_id>.jpg` and videos
+    `<status_id>.mp4` of each friend), as a sorted array of keys computed
+    from their path relative to image_path, loaded once. The keys added
+    during the run are appended to a log file as they come and merged in
+    the array at exit.
+
+    The index is built from image_path on first use. It does not see the
+    files removed or added by hand, run bin/media_index.py --rebuild then.
+    """
+
+    def __init__(self, config):
+        self._root = "%s/" % config.get('path', 'image_path').rstrip('/')
+        self._daily_path = config.get('path', 'daily_path')
+        self.filepath = get_option(
+                config, 'path', 'media_index_file',
+                os.path.join(config.get('path', 'data_dir'),
+                             'media_index.bin'))
+        self._log_filepath = '%s.log' % self.filepath
+
+        self._keys = array('L')
+        self._new = set()
+        self._log = None
+
+        if os.path.exists(self.filepath):
+            self._keys = self._read(self.filepath)
+            self._new = set(self._read(self._log_filepath))
+        else:
+            print "build %s" % self.filepath
+            self.rebuild()
+
+        if self._log is None:
+            self._log = open(self._log_filepath, 'ab')
+        atexit.register(self.exit)
+
+    @staticmethod
+    def _read(filepath):
+        """ the array of keys in filepath, empty if there is no file """
+        keys = array('L')
+        if os.path.exists(filepath):
+            with open(filepath, 'rb') as fdesc:
+                keys.fromfile(fdesc, os.path.getsize(filepath) / KEY_SIZE)
+        return keys
+
+    def key(self, filepath):
+        """ key of filepath, a path in image_path """
+        if filepath.startswith(self._root):
+            filepath = filepath[len(self._root):]
+        return int(md5(filepath).hexdigest()[:2 * KEY_SIZE], 16)
+
+    def _has_key(self, key):
+        if key in self._new:
+            return True
+        position = bisect_left(self._keys, key)
+        return position < len(self._keys) and self._keys[position] == key
+
+    def __contains__(self, filepath):
+        return self._has_key(self.key(filepath))
+
+    def __len__(self):
+        return len(self._keys) + len(self._new)
+
+    def add(self, filepath):
+        """ filepath was downloaded """
+        key = self.key(filepath)
+        if self._has_key(key):
+            return
+
+        self._new.add(key)
+        array('L', [key]).tofile(self._log)
+        self._log.flush()
+
+    def _write(self, keys):
+        """ replace the index by the sorted `keys`, empty the log """
+        tmp_filepath = '%s.tmp' % self.filepath
+        with open(tmp_filepath, 'wb') as fdesc:
+            keys.tofile(fdesc)
+            fdesc.flush()
+            os.fsync(fdesc.fileno())
+        os.rename(tmp_filepath, self.filepath)
+
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self._log_filepath, 'wb')
+
+        self._keys = keys
+        self._new = set()
+
+    def disk_keys(self):
+        """ the keys of the files in image_path, the daily links excepted """
+        return set([self.key(filepath)
+                    for filepath, _, _ in list_files(self._root,
+                                                     [self._daily_path])])
+
+    def rebuild(self):
+        """ index the files of image_path again """
+        self._write(array('L', sorted(self.disk_keys())))
+
+    def verify(self):
+        """
+        (number of indexed files not on disk anymore, number of files on
+        disk not indexed)
+        """
+        on_disk = self.disk_keys()
+        indexed = set(self._keys).union(self._new)
+        return len(indexed - on_disk), len(on_disk - indexed)
+
+    def sync(self):
+        """ merge the keys added in the index """
+        if self._new:
+            print "backup %s" % self.filepath
+            self._write(array('L', sorted(self._new.union(self._keys))))
+
+    def exit(self):
+        """ merge the keys added in the index at the end """
+        self.sync()
+        self._log.close()
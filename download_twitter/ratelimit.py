@@ -0,0 +1,360 @@
+#!/usr/bin/python
+"""
+Soft ratelimit on the twitter api, per endpoint 15 minutes windows
+"""
+
+import sqlite3
+import threading
+import time
+
+from .exception import InternalRateLimit
+
+
+class Window(object):
+    """
+    Calls done on an endpoint during the last 15 minutes, counted in one
+    bucket per minute. Buckets are reused in a ring (minute % 15) and
+    the total is kept up to date, so recording and checking a call cost
+    at most one pass over the 15 buckets.
+    """
+    SIZE = 15
+    GRANULARITY = 60
+
+    def __init__(self, state=None):
+        self.buckets = [[None, 0] for _ in range(self.SIZE)]
+        self.last = None
+        self.total = 0
+
+        # what twitter told us in the x-rate-limit-* headers
+        self.remaining = None
+        self.reset = None
+
+        if isinstance(state, (list, tuple)) and len(state) in (2, 4):
+            # (last minute, buckets[, remaining, reset]) from `state`,
+            # anything else is dropped
+            self.last, buckets = state[:2]
+            self.buckets = [list(bucket) for bucket in buckets]
+            self.total = sum([bucket[1] for bucket in self.buckets])
+            if len(state) == 4:
+                self.remaining, self.reset = state[2:]
+
+    @classmethod
+    def minute(cls, now=None):
+        """ the minute we are in (since epoch) """
+        return int(time.time() if now is None else now) / cls.GRANULARITY
+
+    def advance(self, now=None):
+        """ forget the calls which are out of the window now """
+        minute = self.minute(now)
+        start = minute - self.SIZE + 1
+        if self.last is not None:
+            start = max(start, self.last + 1)
+
+        for expired in range(start, minute + 1):
+            bucket = self.buckets[expired % self.SIZE]
+            self.total -= bucket[1]
+            bucket[0], bucket[1] = expired, 0
+
+        if self.last is None or minute > self.last:
+            self.last = minute
+
+    def record(self, now=None):
+        """ count a call """
+        self.advance(now)
+        self.buckets[self.last % self.SIZE][1] += 1
+        self.total += 1
+
+    def count(self, now=None):
+        """ number of calls in the window """
+        self.advance(now)
+        return self.total
+
+    def update(self, remaining, reset):
+        """
+        twitter says `remaining` calls are left until `reset`, the count
+        of a same window only goes down (the responses of concurrent calls
+        come in any order)
+        """
+        if reset == self.reset and self.remaining is not None:
+            remaining = min(remaining, self.remaining)
+        self.remaining = remaining
+        self.reset = reset
+
+    def server_remaining(self, now=None):
+        """ calls left according to twitter, None if we don't know """
+        now = time.time() if now is None else now
+        if self.reset is None or now >= self.reset:
+            self.remaining = self.reset = None
+        return self.remaining
+
+    def frees_at(self):
+        """ timestamp at which we can call again """
+        if self.remaining is not None:
+            return self.reset
+
+        minutes = [minute for minute, count in self.buckets
+                   if minute is not None and count]
+        if not minutes:
+            return time.time()
+        return (min(minutes) + self.SIZE) * self.GRANULARITY
+
+    def state(self):
+        """ what we need to persist the window """
+        return (self.last, [tuple(bucket) for bucket in self.buckets],
+                self.remaining, self.reset)
+
+
+class RateLimiter(object):
+    """
+    Check and record the calls to the rate limited endpoints.
+
+    `limits` maps an endpoint to the number of calls allowed in 15 minutes
+    (-1 for no limit), windows are persisted in `store` (a `PklDict`).
+    Once twitter told us how many calls are left for an endpoint (see
+    `update`), that number is used instead of the configured limit until
+    twitter resets its window.
+    When the limit is reached `acquire` raises `InternalRateLimit`, or
+    waits for a call to be available if `block` is set.
+    The limiter is shared by all the threads using the api.
+    """
+
+    def __init__(self, store, limits, block=False):
+        self._store = store
+        self._limits = limits
+        self._block = block
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self._limits
+
+    def configure(self, limits, block=False):
+        """ new limits (the config was reloaded), the windows are kept """
+        with self._lock:
+            self._limits = limits
+            self._block = block
+
+    def window(self, url):
+        """ window of `url`, from the store on first use """
+        if url not in self._windows:
+            self._windows[url] = Window(self._store.get(url))
+        return self._windows[url]
+
+    def _allowed(self, url, now=None):
+        """ can we call `url` now """
+        window = self.window(url)
+        remaining = window.server_remaining(now)
+        if remaining is not None:
+            return remaining > 0
+
+        limit = self._limits[url]
+        return limit == -1 or window.count(now) < limit
+
+    def acquire(self, url, now=None):
+        """ record a call to `url`, if the limit allows it """
+        while True:
+            with self._lock:
+                window = self.window(url)
+                if self._allowed(url, now):
+                    window.record(now)
+                    if window.remaining is not None:
+                        window.remaining -= 1
+                    self._store[url] = window.state()
+                    return
+
+                if not self._block:
+                    raise InternalRateLimit()
+
+                wait = window.frees_at() - time.time()
+
+            print "    %s ratelimited, waiting %ds" % (url, wait)
+            time.sleep(max(wait, 1))
+
+    def update(self, url, headers):
+        """ use the x-rate-limit-* headers of a twitter response """
+        try:
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = int(headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+            window = self.window(url)
+            window.update(remaining, reset)
+            self._store[url] = window.state()
+
+    def frees_at(self, url):
+        """ timestamp at which `url` can be called, now if it can """
+        with self._lock:
+            if url not in self._limits or self._allowed(url):
+                return time.time()
+            return self.window(url).frees_at()
+
+    def usage(self):
+        """ {url: [limit, calls in the window, calls left for twitter]} """
+        with self._lock:
+            return dict([(url, [limit, self.window(url).count(),
+                                self.window(url).server_remaining()])
+                         for url, limit in self._limits.items()])
+
+
+class SharedRateLimiter(object):
+    """
+    `RateLimiter` shared by processes on several hosts through a sqlite
+    database (the one of the `jobqueue.JobQueue`): the calls of the 15
+    minutes window are counted per minute in a table, checked and recorded
+    in one transaction. `account` keeps apart the windows of the accounts
+    (see `shard.accounts`).
+    """
+    SIZE = Window.SIZE
+    GRANULARITY = Window.GRANULARITY
+
+    def __init__(self, filepath, limits, block=False, account=''):
+        self._limits = limits
+        self._block = block
+        self._account = account
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(filepath, timeout=60,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        # not WAL: its shared memory index does not work across hosts
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        self._db.execute('CREATE TABLE IF NOT EXISTS ratelimit_calls '
+                         '(url TEXT, minute INTEGER, count INTEGER, '
+                         'PRIMARY KEY (url, minute))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS ratelimit_server '
+                         '(url TEXT PRIMARY KEY, remaining INTEGER, '
+                         'reset INTEGER)')
+
+    def __contains__(self, url):
+        return url in self._limits
+
+    def configure(self, limits, block=False):
+        """ new limits (the config was reloaded) """
+        with self._lock:
+            self._limits = limits
+            self._block = block
+
+    def _key(self, url):
+        return '%s:%s' % (self._account, url)
+
+    def _server(self, url, now):
+        """ (remaining, reset) according to twitter, None if unknown """
+        row = self._db.execute('SELECT remaining, reset FROM ratelimit_server '
+                               'WHERE url = ?', (self._key(url), )).fetchone()
+        if row is None or now >= row[1]:
+            return None
+        return row
+
+    def _count(self, url, now):
+        minute = Window.minute(now)
+        return self._db.execute(
+                'SELECT COALESCE(SUM(count), 0) FROM ratelimit_calls '
+                'WHERE url = ? AND minute > ?',
+                (self._key(url), minute - self.SIZE)).fetchone()[0]
+
+    def _allowed(self, url, now):
+        server = self._server(url, now)
+        if server is not None:
+            return server[0] > 0
+
+        limit = self._limits[url]
+        return limit == -1 or self._count(url, now) < limit
+
+    def _frees_at(self, url, now):
+        server = self._server(url, now)
+        if server is not None:
+            return server[1]
+
+        minute = self._db.execute(
+                'SELECT MIN(minute) FROM ratelimit_calls '
+                'WHERE url = ? AND minute > ? AND count > 0',
+                (self._key(url), Window.minute(now) - self.SIZE)).fetchone()[0]
+        if minute is None:
+            return now
+        return (minute + self.SIZE) * self.GRANULARITY
+
+    def acquire(self, url, now=None):
+        """ record a call to `url`, if the limit allows it """
+        while True:
+            current = time.time() if now is None else now
+            with self._lock:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    allowed = self._allowed(url, current)
+                    if allowed:
+                        self._record(url, current)
+                    wait = 0 if allowed else (
+                            self._frees_at(url, current) - current)
+                    self._db.execute('COMMIT')
+                except Exception:
+                    self._db.execute('ROLLBACK')
+                    raise
+
+            if allowed:
+                return
+            if not self._block:
+                raise InternalRateLimit()
+
+            print "    %s ratelimited, waiting %ds" % (url, wait)
+            time.sleep(max(wait, 1))
+
+    def _record(self, url, now):
+        key = self._key(url)
+        minute = Window.minute(now)
+        self._db.execute('INSERT OR IGNORE INTO ratelimit_calls '
+                         '(url, minute, count) VALUES (?, ?, 0)',
+                         (key, minute))
+        self._db.execute('UPDATE ratelimit_calls SET count = count + 1 '
+                         'WHERE url = ? AND minute = ?', (key, minute))
+        self._db.execute('UPDATE ratelimit_server '
+                         'SET remaining = remaining - 1 '
+                         'WHERE url = ? AND reset > ?', (key, now))
+        self._db.execute('DELETE FROM ratelimit_calls '
+                         'WHERE url = ? AND minute <= ?',
+                         (key, minute - self.SIZE))
+
+    def update(self, url, headers):
+        """ use the x-rate-limit-* headers of a twitter response """
+        try:
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = int(headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        # the count of a same window only goes down
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('UPDATE ratelimit_server '
+                                 'SET remaining = MIN(remaining, ?) '
+                                 'WHERE url = ? AND reset = ?',
+                                 (remaining, self._key(url), reset))
+                self._db.execute('INSERT OR REPLACE INTO ratelimit_server '
+                                 '(url, remaining, reset) SELECT ?, ?, ? '
+                                 'WHERE NOT EXISTS (SELECT 1 FROM '
+                                 'ratelimit_server WHERE url = ? '
+                                 'AND reset = ?)',
+                                 (self._key(url), remaining, reset,
+                                  self._key(url), reset))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def frees_at(self, url):
+        """ timestamp at which `url` can be called, now if it can """
+        now = time.time()
+        with self._lock:
+            if url not in self._limits or self._allowed(url, now):
+                return now
+            return self._frees_at(url, now)
+
+    def usage(self):
+        """ {url: [limit, calls in the window, calls left for twitter]} """
+        now = time.time()
+        with self._lock:
+            return dict([(url, [limit, self._count(url, now),
+                                (self._server(url, now) or [None])[0]])
+                         for url, limit in self._limits.items()])
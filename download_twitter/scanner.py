@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Incremental hashing of the images on disk, without their exif
+"""
+
+from collections import defaultdict
+import mmap
+from multiprocessing import Pool, cpu_count
+import os
+from stat import S_ISREG
+
+from .cache import ScanCache
+from .exif import payload_hash
+
+
+def hash_file(filepath):
+    """
+    Hash of the image in filepath without its exif (see
+    `exif.payload_hash`), the file is mapped in memory and not read.
+    None if the file can't be read
+    """
+    try:
+        with open(filepath, 'rb') as fdesc:
+            if not os.fstat(fdesc.fileno()).st_size:
+                return payload_hash('')
+
+            data = mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return payload_hash(data)
+            finally:
+                data.close()
+    except (IOError, OSError, ValueError), err:
+        print err
+        return None
+
+
+def _hash_job(job):
+    """ (filepath, size, mtime, hash), run in the pool processes """
+    filepath, size, mtime = job
+    return filepath, size, mtime, hash_file(filepath)
+
+
+def list_files(root, exclude=()):
+    """
+    Yield (filepath, size, mtime) of the files under root, links and the
+    `exclude` directories are skipped
+    """
+    exclude = set([os.path.abspath(path) for path in exclude])
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [dirname for dirname in dirnames
+                       if os.path.abspath(os.path.join(dirpath, dirname))
+                          not in exclude]
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(filepath)
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode):
+                yield filepath, stat.st_size, stat.st_mtime
+
+
+class Scanner(object):
+    """
+    Hash the images of image_path (the daily links excepted) with
+    `processes` processes. The hashes are kept in a `ScanCache` with the
+    size and mtime of the files, only the new or modified files are hashed
+    again on the next scan.
+    """
+
+    def __init__(self, config, processes=None):
+        self._image_path = config.get('path', 'image_path')
+        self._daily_path = config.get('path', 'daily_path')
+        self._processes = processes or cpu_count()
+        self.cache = ScanCache(config)
+
+        self.hashed = 0
+        self.cached = 0
+        self.removed = 0
+
+    def remember(self, filepath, digest):
+        """ filepath holds `digest` (a file we just wrote or linked) """
+        stat = os.stat(filepath)
+        self.cache[filepath] = (stat.st_size, stat.st_mtime, digest)
+
+    def scan(self):
+        """ {filepath: hash} of all the images """
+        hashes = {}
+        jobs = []
+        for filepath, size, mtime in list_files(self._image_path,
+                                                [self._daily_path]):
+            cached = self.cache.get(filepath)
+            if cached is not None and cached[:2] == (size, mtime):
+                hashes[filepath] = cached[2]
+            else:
+                jobs.append((filepath, size, mtime))
+        self.cached = len(hashes)
+        self.removed = 0
+
+        if jobs:
+            pool = Pool(min(self._processes, len(jobs)))
+            try:
+                for filepath, size, mtime, digest in pool.imap_unordered(
+                        _hash_job, jobs, chunksize=64):
+                    if digest is None:
+                        continue
+                    self.cache[filepath] = (size, mtime, digest)
+                    hashes[filepath] = digest
+            finally:
+                pool.terminate()
+                pool.join()
+        self.hashed = len(jobs)
+
+        for filepath in [filepath for filepath in self.cache.keys()
+                         if filepath not in hashes]:
+            del self.cache[filepath]
+            self.removed += 1
+
+        return hashes
+
+    @staticmethod
+    def duplicates(hashes):
+        """
+        [[filepath, ...], ...] the groups of files with the same image, files
+        which are already links to each other are one
+        """
+        by_hash = defaultdict(list)
+        for filepath, digest in hashes.items():
+            by_hash[digest].append(filepath)
+
+        groups = []
+        for filepaths in by_hash.values():
+            if len(filepaths) < 2:
+                continue
+
+            inodes = {}
+            for filepath in sorted(filepaths):
+                stat = os.stat(filepath)
+                inodes.setdefault((stat.st_dev, stat.st_ino), filepath)
+            if len(inodes) > 1:
+                groups.append(sorted(inodes.values()))
+        return sorted(groups)
+
+    def stats(self):
+        """ summary of the last scan """
+        return "%d images hashed, %d from the cache, %d removed" % (
+                self.hashed, self.cached, self.removed)
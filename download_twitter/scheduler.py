@@ -0,0 +1,167 @@
+#!/usr/bin/python
+"""
+Order in which the friends timelines are fetched
+"""
+
+import heapq
+import time
+
+from .activity import ActivityModel
+from .cache import ScheduleState
+from .config import get_option
+
+
+# the weight of a friend is multiplied by the one of its list
+LIST_MULTIPLIER = {'Person': 1, 'Rss': 0.8, None: 0.85}
+
+
+class Policy(object):
+    """
+    Priority of a friend, the friends with the lowest priority are fetched
+    first. `weight` is the number of fetches which gave (almost) nothing,
+    `in_list` the list of the friend (None if it is in none), `state`
+    its `ScheduleState` and `now` the time of the round
+    """
+    name = None
+
+    def __init__(self, config):
+        self._config = config
+
+    @staticmethod
+    def multiplier(in_list):
+        """ multiplier of the weight for a friend of the list `in_list` """
+        return LIST_MULTIPLIER.get(in_list, LIST_MULTIPLIER[None])
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        raise NotImplementedError()
+
+
+class WeightPolicy(Policy):
+    """ the least weighted friends first (weight times list multiplier) """
+    name = 'weight'
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        return weight * self.multiplier(in_list)
+
+
+class LeastRecentPolicy(Policy):
+    """ the friends fetched the longest time ago first """
+    name = 'lru'
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        return state.get('fetched', 0)
+
+
+class ProductivePolicy(Policy):
+    """ the friends with the most medias per fetch first """
+    name = 'productive'
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        # never fetched friends count as one media per fetch
+        return - (state.get('medias', 0) + 1.0) / (state.get('fetches', 0) + 1)
+
+
+class ListPolicy(Policy):
+    """
+    the friends of the lists of `list_priority` (schedule config, comma
+    separated, Person and Rss by default) first, in that order, by weight
+    in a list
+    """
+    name = 'list'
+
+    def __init__(self, config):
+        Policy.__init__(self, config)
+        self._ranks = dict([
+                (name.strip(), rank) for rank, name in enumerate(get_option(
+                    config, 'schedule', 'list_priority', 'Person, Rss'
+                ).split(','))])
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        return (self._ranks.get(in_list, len(self._ranks)),
+                weight * self.multiplier(in_list))
+
+
+class AdaptivePolicy(Policy):
+    """
+    the friends due for a poll (see `ActivityModel.next_poll`, kept in
+    the state by `FriendScheduler.fetched`) first, then the others, by
+    medias they should have posted since their last fetch: a timeline call
+    is spent where it should bring the most medias. Run
+    bin/simulate_polling.py --seed once to start from the rates of the
+    tweets archive.
+    """
+    name = 'adaptive'
+
+    def __init__(self, config):
+        Policy.__init__(self, config)
+        self._activity = ActivityModel(config)
+
+    def priority(self, friend_id, weight, in_list, state, now):
+        return (state.get('next_poll', 0) > now,
+                - self._activity.expected(state, now))
+
+
+POLICIES = dict([(policy.name, policy) for policy in (
+    WeightPolicy, LeastRecentPolicy, ProductivePolicy, ListPolicy,
+    AdaptivePolicy)])
+
+
+class FriendScheduler(object):
+    """
+    Give the friends in the order of the `policy` of the schedule config
+    (see `POLICIES`, weight by default).
+
+    The priorities are computed once per round and kept in a heap, the
+    friends are popped from it as they are asked for, so a round stopped
+    by the ratelimit after a few friends costs little. What each fetch
+    gave is kept in a `ScheduleState` for the next rounds and runs.
+    """
+
+    def __init__(self, config, friends, weights, state=None):
+        self._friends = friends
+        self._weights = weights
+        self.state = ScheduleState(config) if state is None else state
+        self.activity = None
+        self.policy = None
+        self.configure(config)
+
+    def configure(self, config):
+        """ policy and activity model from the config """
+        name = get_option(config, 'schedule', 'policy', 'weight')
+        if name not in POLICIES:
+            raise ValueError('unknown schedule policy %s (%s)' % (
+                    name, ', '.join(sorted(POLICIES))))
+        self.policy = POLICIES[name](config)
+        self.activity = ActivityModel(config)
+
+    def order(self, friend_in_list, now=None, select=None):
+        """
+        Yield (friend_id, priority) for the friends, the first to fetch
+        first, `friend_in_list` maps a friend to its list. Only the friends
+        `select` (a function of the friend id) returns True for if given
+        """
+        now = time.time() if now is None else now
+        heap = [(self.policy.priority(friend_id, weight,
+                                      friend_in_list.get(friend_id),
+                                      self.state.get(friend_id, {}), now),
+                 friend_id)
+                for friend_id, weight in [
+                        (friend_id, self._weights.get(friend_id, 0))
+                        for friend_id in self._friends.keys()]
+                if select is None or select(friend_id)]
+        heapq.heapify(heap)
+
+        while heap:
+            priority, friend_id = heapq.heappop(heap)
+            yield friend_id, priority
+
+    def fetched(self, friend_id, medias, now=None):
+        """ friend_id timeline was fetched and gave `medias` medias """
+        now = time.time() if now is None else now
+        state = dict(self.state.get(friend_id, {}))
+        self.activity.observe(state, medias, now)
+        state['fetched'] = now
+        state['fetches'] = state.get('fetches', 0) + 1
+        state['medias'] = state.get('medias', 0) + medias
+        state['next_poll'] = self.activity.next_poll(state)
+        self.state[friend_id] = state
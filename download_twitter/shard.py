@@ -0,0 +1,50 @@
+#!/usr/bin/python
+"""
+Several twitter accounts (credentials) sharing the friends timelines
+"""
+
+from bisect import bisect
+from hashlib import md5
+
+
+# the credentials of the main section are the account of this name
+MAIN = 'main'
+ACCOUNT_PREFIX = 'account:'
+
+
+def accounts(config):
+    """ names of the accounts of the config, the main one first """
+    return [MAIN] + sorted([section[len(ACCOUNT_PREFIX):]
+                            for section in config.sections()
+                            if section.startswith(ACCOUNT_PREFIX)])
+
+
+def account_section(account):
+    """ config section of the credentials of `account` """
+    return MAIN if account == MAIN else ACCOUNT_PREFIX + account
+
+
+def hash_key(value):
+    """ position of value on the ring """
+    return int(md5(str(value)).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of the friends over the accounts: each account has
+    `replicas` points on a ring and a friend goes to the account of the
+    next point, so adding or removing an account only moves the friends
+    of its points.
+    """
+    REPLICAS = 64
+
+    def __init__(self, names, replicas=REPLICAS):
+        self._ring = sorted([(hash_key('%s#%d' % (name, replica)), name)
+                             for name in names
+                             for replica in range(replicas)])
+        self._points = [point for point, _ in self._ring]
+
+    def get(self, key):
+        """ the account of `key` """
+        position = bisect(self._points, hash_key(key)) % len(self._ring)
+        return self._ring[position][1]
@@ -4,14 +4,27 @@ Twitter module
 """
 
 from datetime import datetime
-import operator
+import time
 
-from .api import API
+from .api import API, ratelimits
+from .config import get_option
 from .cache import (LastId, FriendList, ListContent, AllTweets, WeightFriends,
-                    DeletedFriends)
-from .image import MediaFactory
-from .utils import simplify_status
-from .exception import RateLimit
+                    DeletedFriends, TweetJournal)
+from .daily import DailyLinker
+from .dedup import Deduplicator
+from .image import MediaFactory, forget_dirs
+from .links import LinkResolver
+from .mediaindex import MediaIndex
+from .scheduler import FriendScheduler, Policy
+from .shard import MAIN, HashRing, accounts
+from .utils import simplify_status, background
+from .exception import RateLimit, IncompletePagination
+
+
+# the endpoint our runs are limited by
+TIMELINE = 'statuses/user_timeline.json'
+# end marker of the pages of a friend when one of them failed
+INCOMPLETE = 'incomplete'
 
 
 class Twitter(API):
@@ -20,11 +33,85 @@ class Twitter(API):
         """ Init the path we will need to download (and the API) """
         API.__init__(self, config)
 
+        # the api of each account, the friends are spread over them
+        self.accounts = accounts(config)
+        self.shards = dict([(account, self if account == MAIN
+                                      else API(config, account, self.cursors))
+                            for account in self.accounts])
+        self.ring = HashRing(self.accounts)
+
         self.friends_last_id = LastId(config)
         self.friends = FriendList(config)
         self.weights = WeightFriends(config)
+        self.scheduler = FriendScheduler(config, self.friends, self.weights)
         self.listcontent = ListContent(config)
         self.tweets = AllTweets(config)
+        self.journal = TweetJournal(config)
+        self.resolver = LinkResolver(config)
+        self.dedup = Deduplicator(config)
+        self.media_index = MediaIndex(config)
+        self.daily = DailyLinker(config)
+
+        self._prefetch = 0
+        self._max_pages = 0
+        self._stopping = False
+        self.configure(config)
+
+    def configure(self, config):
+        """
+        Use the download, ratelimit and schedule options of config, also
+        called when the daemon reloads its config
+        """
+        self._config = config
+        # number of friends timelines fetched ahead of the media download
+        self._prefetch = get_option(config, 'download', 'prefetch', 0)
+        # maximum number of pages of 200 statuses fetched for a friend
+        self._max_pages = get_option(config, 'download', 'max_pages', 0)
+
+        for api in self.shards.values():
+            api.twitter.default_ratelimit = ratelimits(config)
+            api.twitter.limiter.configure(
+                    api.twitter.default_ratelimit,
+                    get_option(config, 'download', 'wait_ratelimit', False))
+        self.scheduler.configure(config)
+        self.dedup.enabled = get_option(config, 'dedup', 'enabled', False)
+
+    def stop(self):
+        """ make `run` stop after the friend it is on (from a signal) """
+        self._stopping = True
+
+    def next_run(self):
+        """
+        when the timeline ratelimit of one of the accounts lets a new run
+        fetch something
+        """
+        return min([api.twitter.limiter.frees_at(TIMELINE)
+                    for api in self.shards.values()])
+
+    def sync(self):
+        """ write the state on disk, without waiting for the exit """
+        self.daily.flush()
+        for store in (self.friends_last_id, self.weights,
+                      self.scheduler.state, self.cursors,
+                      self.dedup.hashes, self.resolver.cache,
+                      self.media_index, self.journal):
+            store.sync()
+        for api in self.shards.values():
+            api.twitter.ratelimit.sync()
+
+    def reload_lists(self):
+        """
+        Read the friends and lists again (bin/refresh_lists.py writes
+        them), for a long running process which only reads them: they are
+        not written back by this one anymore
+        """
+        for store in (self.friends, self.listcontent):
+            store.readonly = True
+            store.reload()
+
+    def known_users(self):
+        """ our friends are in the user index from the start """
+        return self.friends.items()
 
     def get_list_content(self):
         """ Get list content and friends in list """
@@ -37,87 +124,209 @@ class Twitter(API):
         the weight depend on the number of call done factor
         the list friend is in
         """
-        mux = {'Person': 1, 'Rss': 0.8, None: 0.85}
+        friend_in_list = self.listcontent.get('friend_in_list', {})
 
         return [(friend_id, weight *
-                 mux[self.listcontent.get('friend_in_list', {}).get(friend_id)])
+                 Policy.multiplier(friend_in_list.get(friend_id)))
                  for friend_id, weight in self.weights.items()]
 
-    def order_friends(self):
-        """ Return the friends we queried the less often, """
+    def order_friends(self, account=None):
+        """
+        Yield (friend_id, friend, priority) for our friends, those of
+        `account` only if given, in the order of the schedule policy (see
+        `FriendScheduler`)
+        """
+        select = None
+        if account is not None and len(self.accounts) > 1:
+            select = lambda friend_id: self.ring.get(friend_id) == account
+
+        friend_in_list = self.listcontent.get('friend_in_list', {})
+        for key, priority in self.scheduler.order(friend_in_list,
+                                                  select=select):
+            yield key, self.friends[key], priority
+
+    def friends_statuses(self, account=MAIN):
+        """
+        Yield (friend_id, weight, since_id, statuses) for each page of
+        statuses of the friends of `account` in `order_friends` order,
+        followed by (friend_id, weight, since_id, None) once all the pages
+        of the friend are there, or (friend_id, weight, since_id,
+        INCOMPLETE) when a page failed. Raise `RateLimit` when we can't go
+        further
+        """
+        api = self.shards[account]
+        for friend_id, _, weight in self.order_friends(account):
+            since_id = self.friends_last_id.get(friend_id)
+            try:
+                for statuses in api.iter_statuses(friend_id,
+                                                  since_id=since_id,
+                                                  max_pages=self._max_pages):
+                    yield friend_id, weight, since_id, statuses
+            except IncompletePagination:
+                yield friend_id, weight, since_id, INCOMPLETE
+                continue
+            yield friend_id, weight, since_id, None
 
-        def less_call(el1, el2):
-            """ compare on the 2nd element of the tuple """
-            return cmp(el1[1], el2[1])
+    @staticmethod
+    def friend_pages(first, friends_statuses):
+        """
+        the pages of `friends_statuses` up to the end of the friend, raise
+        `IncompletePagination` at the end of a friend whose pages failed
+        """
+        statuses = first[3]
+        while statuses is not None:
+            if statuses is INCOMPLETE:
+                raise IncompletePagination(first[0])
+            yield statuses
+            try:
+                statuses = next(friends_statuses)[3]
+            except StopIteration:
+                # stopped before the end of the friend
+                raise IncompletePagination(first[0])
 
-        weights = sorted(self.ponderated_weights, cmp=less_call)
+    def retrieve_friend(self, friend_id, weight, since_id, pages, is_in_list):
+        """
+        Retrieve the medias of the pages of statuses of a friend, as they
+        come. Return the number of images and the friend name (None if
+        there was no new status)
 
-        return [(key, self.friends[key], weight)
-                    for key, weight in weights
-                    if key in self.friends.keys()]
+        The last id of the friend only moves once its pages went down to
+        `since_id`: when a page failed, the next run fetches the older
+        statuses again.
+        """
+        media_factory = None
+        username = None
+        last_id = None
+        complete = True
+        nb_statuses = 0
+        images, images_rt, videos, videos_rt = 0, 0, 0, 0
+
+        try:
+            for statuses in pages:
+                if media_factory is None:
+                    username = statuses[0]['user']['screen_name'].replace(
+                            '/', ' ')
+                    last_id = statuses[0]['id']
+
+                    print ("%(friend_id)s : %(name)s (%(weight)s)%(in_list)s"
+                           "%(is_new)s" % {
+                                'friend_id': friend_id,
+                                'name': username,
+                                'weight': weight,
+                                'in_list': " [%s]" % is_in_list if is_in_list else '',
+                                'is_new': ' (new user)' if not since_id else '',
+                          })
+
+                    media_factory = MediaFactory(self,
+                                               self._config,
+                                               is_in_list,
+                                               username)
+
+                counts = media_factory.retrieve_all(statuses)
+                images += counts[0]
+                images_rt += counts[1]
+                videos += counts[2]
+                videos_rt += counts[3]
+                nb_statuses += len(statuses)
+        except IncompletePagination:
+            complete = False
+            print "    * %s timeline incomplete, will be fetched again" % (
+                    friend_id)
+
+        if media_factory is None:
+            self.weights[friend_id] = self.weights.get(friend_id, 0) + 1
+            self.scheduler.fetched(friend_id, 0)
+            return 0, None
+
+        if complete:
+            self.friends_last_id[friend_id] = last_id
+
+        if images < 2:
+            self.weights[friend_id] = self.weights.get(friend_id, 0) + 1
+        self.scheduler.fetched(friend_id, images + videos)
+
+        print ("    * %(statuses)d status retrieved %(images)s pics "
+               "with %(images_rt)s retweets and %(videos)s videos (until %(last_id)s)" % {
+                    'statuses': nb_statuses,
+                    'images': images,
+                    'images_rt': images_rt,
+                    'videos': videos,
+                    'videos_rt': videos_rt,
+                    'last_id': last_id,
+              })
+        return images, username
 
     def run(self,):
-        """ Run the twitter image downloader process """
+        """
+        Run the twitter image downloader process
+
+        The statuses are fetched page by page and their medias retrieved as
+        the pages come. With a `prefetch` in the download config, the
+        timelines of the next friends are fetched while the medias of the
+        current one are downloaded. The friends are still treated one after
+        the other, in order, by this thread.
+
+        With several accounts, each one fetches the timelines of its
+        friends (see `shard.HashRing`) in its own thread and this thread
+        takes a friend of each account in turn. An account stops at its
+        ratelimit, the others go on.
+        """
         list_content, friend_in_list = self.get_list_content()
         print "got %d lists %s" % (
                 len(list_content),
                 ', '.join([name for name in list_content]))
         print "%d friends in list" % (len(self.friends),)
+        forget_dirs()
+        MediaFactory.prepare_daily(self._config, list_content)
 
         total_pic = 0
         not_affected_friends = []
 
-        for friend_id, _, weight in self.order_friends():
-            since_id = self.friends_last_id.get(friend_id)
-            is_in_list = friend_in_list.get(friend_id, '')
-
-            try:
-                statuses = self.get_statuses_for_friend(friend_id, since_id)
-            except RateLimit:
-                print "Ratelimited"
-                break
-
-            if not statuses:
-                self.weights[friend_id] = self.weights.get(friend_id, 0) + 1
-                continue
-
-            username = statuses[0]['user']['screen_name'].replace('/', ' ')
-            if not is_in_list:
-                not_affected_friends.append(username)
-
-            print ("%(friend_id)s : %(name)s (%(weight)s)%(in_list)s"
-                   "%(is_new)s" % {
-                        'friend_id': friend_id,
-                        'name': username,
-                        'weight': weight,
-                        'in_list': " [%s]" % is_in_list if is_in_list else '',
-                        'is_new': ' (new user)' if not since_id else '',
-                  })
-
-            media_factory = MediaFactory(self,
-                                       self._config,
-                                       is_in_list,
-                                       username)
-
-            images, images_rt, videos, videos_rt = media_factory.retrieve_all(statuses)
-            total_pic += images
-            self.friends_last_id[friend_id] = statuses[0]['id']
-
-            if images < 2:
-                self.weights[friend_id] = self.weights.get(friend_id, 0) + 1
-
-            print ("    * %(statuses)d status retrieved %(images)s pics "
-                   "with %(images_rt)s retweets and %(videos)s videos (until %(last_id)s)" % {
-                        'statuses': len(statuses),
-                        'images': images,
-                        'images_rt': images_rt,
-                        'videos': videos,
-                        'videos_rt': videos_rt,
-                        'last_id': statuses[0]['id'],
-                  })
+        streams = [(account, self.friends_statuses(account))
+                   for account in self.accounts]
+        if self._prefetch or len(streams) > 1:
+            streams = [(account, background(stream, max(self._prefetch, 1),
+                                            lambda: self._stopping))
+                       for account, stream in streams]
+
+        running = list(streams)
+        try:
+            while running and not self._stopping:
+                for account, friends_statuses in list(running):
+                    try:
+                        first = next(friends_statuses)
+                        friend_id, weight, since_id, _ = first
+                        is_in_list = friend_in_list.get(friend_id, '')
+                        images, username = self.retrieve_friend(
+                                friend_id, weight, since_id,
+                                self.friend_pages(first, friends_statuses),
+                                is_in_list)
+                    except StopIteration:
+                        running.remove((account, friends_statuses))
+                        continue
+                    except RateLimit:
+                        print "Ratelimited%s" % (
+                                ' (%s)' % account if len(streams) > 1 else '')
+                        running.remove((account, friends_statuses))
+                        continue
+
+                    total_pic += images
+                    if username and not is_in_list:
+                        not_affected_friends.append(username)
+
+                    if self._stopping:
+                        print "Stopped"
+                        break
+        finally:
+            for _, friends_statuses in streams:
+                friends_statuses.close()
 
         if total_pic:
             print "Got %d images" % total_pic
+        print "%d links in the daily dir" % self.daily.flush()
+        print self.resolver.cache.stats()
+        if self.dedup.enabled:
+            print self.dedup.stats()
 
         if not_affected_friends:
             print "Thoses friends are not in a group %s" % (
@@ -125,66 +334,120 @@ class Twitter(API):
 
     def refresh_friend(self):
         """ refresh the friend list cache """
-        old_friends = self.friends.keys()
+        old_friends = set(self.friends.keys())
 
-        for key, value in self.get_friends():
+        for key, value in self.iter_friends(checkpoint='friends'):
             self.friends[key] = value
             self.weights[key] = self.weights.get(key, 0)
-            if key in old_friends:
-                old_friends.remove(key)
+            old_friends.discard(key)
+
+        if 'friends' in self.cursors:
+            print "friend list incomplete, will go on next time"
+            return
 
         deleted_friends = DeletedFriends(self._config)
         for friend_id in old_friends:
             deleted_friends[friend_id] = datetime.now()
 
     def refresh_lists(self):
-        """ refresh the list content cache """
-        for key, value in self.retrieve_list_content().items():
-            self.listcontent[key] = value
+        """
+        refresh the list content cache, the lists not read to the end keep
+        their previous members
+        """
+        self.listcontent.refresh(self.retrieve_list_content())
 
     def cache_all_friend_tweets(self, friend_id):
-        """ get all/missing friends statuses and cache their simple info """
-        last = None
-        statuses = []
-        if friend_id in self.tweets:
-            statuses = self.tweets[friend_id]
-            last = max(statuses, key=operator.itemgetter('id'))['id']
-
-        tweets = self.get_statuses_for_friend(friend_id, last)
-        if not tweets:
+        """
+        get all/missing friends statuses and cache their simple info
+
+        The progress of the pass (the ids it goes between, the pages stored
+        and the archive header after them) is in the journal, written after
+        each page: a pass stopped by a ratelimit, an error or a crash goes
+        on from its last page on the next call.
+        """
+        entry = self.journal.get(friend_id)
+        if entry is None or entry['done']:
+            entry = {
+                'since_id': self.tweets.max_id(friend_id),
+                'max_id': None,
+                'pages': 0,
+                'header': self.tweets.header(friend_id),
+                'done': False,
+                'finished': entry and entry['finished'],
+            }
+            # before the first page: a crash after it must roll it back,
+            # not start a new pass from its newest status
+            self.journal[friend_id] = entry
+            self.journal.sync()
+        else:
+            if self.tweets.header(friend_id) != entry['header']:
+                # a crash between a page and its journal entry
+                self.tweets.rollback(friend_id, entry['header'])
+            print "%s friend resumed after %d pages" % (friend_id,
+                                                        entry['pages'])
+
+        count = 0
+        while True:
+            statuses = self.get_statuses_page(friend_id,
+                                              max_id=entry['max_id'],
+                                              since_id=entry['since_id'])
+            if statuses is None:
+                # twitter error, go on from here next time
+                self.journal[friend_id] = entry
+                return bool(count)
+
+            if statuses:
+                self.tweets.append(friend_id, [simplify_status(status)
+                                               for status in statuses])
+                self.tweets.free(friend_id)
+                count += len(statuses)
+                entry = dict(entry,
+                             max_id=statuses[-1]['id'] - 1,
+                             pages=entry['pages'] + 1,
+                             header=self.tweets.header(friend_id))
+
+            if len(statuses) < 200:
+                break
+            self.journal[friend_id] = entry
+            self.journal.sync()
+
+        last = entry['since_id']
+        self.journal[friend_id] = dict(entry, done=True, finished=time.time())
+        if not count:
             return False
 
         print "%s friend has %d statuses %s" % (
-                friend_id, len(tweets),
+                friend_id, count,
                 'since %s' % last if last else '')
-
-        statuses.extend([simplify_status(tweet) for tweet in tweets])
-
-        self.tweets[friend_id] = statuses
         return True
 
     def cache_all_friends_tweets(self):
         """ loop over all friend and call `cache_all_friend_tweets` """
         count_treated = 0
-        def index(array, element):
-            try:
-                return array.index(element)
-            except ValueError:
-                return -1
-
-        friend_ids = [(index(self.tweets.keys(), str(friend_id)), friend_id)
-                      for friend_id in self.friends.keys()]
-        friend_ids.sort()
-        friend_ids = [i[1] for i in friend_ids]
 
-        for friend_id in [str(key) for key in friend_ids]:
+        # friends never cached first, then the passes to go on, then the
+        # least recently cached
+        def position(friend_id):
+            entry = self.journal.get(friend_id)
+            if entry is None:
+                index = self.tweets.index.get(friend_id)
+                # archived before the journal
+                return (index['mtime'], friend_id) if index else (-1,
+                                                                  friend_id)
+            if not entry['done']:
+                return (0, friend_id)
+            return (entry['finished'], friend_id)
+
+        for friend_id in sorted([str(key) for key in self.friends.keys()],
+                                key=position):
             try:
-                if self.cache_all_friend_tweets(friend_id):
-                    self.tweets.free(friend_id)
+                self.cache_all_friend_tweets(friend_id)
                 count_treated += 1
             except RateLimit:
                 print "Ratelimited"
                 break
+        self.journal.sync()
+        self.tweets.sync()
 
         return count_treated
 
@@ -3,6 +3,21 @@
 Utils functions
 """
 
+import Queue
+import sys
+import threading
+import urlparse
+
+
+# media kinds a status can hold
+IMAGE = 'image'
+VIDEO = 'video'
+
+# hosts of the videos we download, and the link shorteners that may hide them
+VIDEO_HOSTS = ('vine.co', )
+SHORTENERS = ('t.co', 'bit.ly', 'ow.ly', 'goo.gl', 'dlvr.it', 'ift.tt',
+              'buff.ly', 'tinyurl.com', 'fb.me', 'j.mp')
+
 
 def sanitize(string):
     """ Remove all non ascii chars to be able to put the string in exif """
@@ -11,7 +26,9 @@ def sanitize(string):
 
 ## status treatments
 def is_retweet(status):
-    """ says if a status is a retweet or not """
+    """ says if a status is a retweet or not (also of simplified statuses) """
+    if 'restatus' in status:
+        return status['restatus']
     return ('retweeted_status' in status
             and status['retweeted_status']['user']['screen_name']
                 != status['user']['screen_name'])
@@ -28,10 +45,14 @@ def simplify_status(status):
             'name': status['user']['name'],
         },
     }
+    ret['entities'] = {
+        'urls': [{
+            'url': url['url'],
+            'expanded_url': url.get('expanded_url'),
+        } for url in status['entities'].get('urls', [])],
+    }
     if 'media' in status['entities']:
-        ret['entities'] = {
-            'media': status['entities']['media'],
-        }
+        ret['entities']['media'] = status['entities']['media']
     ret['restatus'] = is_retweet(status)
     return ret
 
@@ -39,4 +60,132 @@ def simplify_status(status):
 def get_images_from_status(status):
     """ Extract medias from a twitter status """
     return [(media['id_str'], media['media_url'])
-            for media in status['entities'].get('media', [])]
+            for media in status.get('entities', {}).get('media', [])]
+
+
+def get_text_links(status):
+    """
+    The links in the text of a status, for the statuses cached without
+    their urls entity
+    """
+    urls = [word for word in status['text'].split(' ')
+                 if word.startswith('http')
+                     and '://' in word]
+
+    ret = []
+    for url in urls:
+        # right now t.co urls are 22 long
+        if url.startswith('https://'):
+            ret.append(url[0:23])
+        else:
+            ret.append(url[0:22])
+    return ret
+
+
+def get_host(url):
+    """ host of an url, without www """
+    try:
+        host = urlparse.urlsplit(url).netloc.lower()
+    except ValueError:
+        return ''
+    return host[4:] if host.startswith('www.') else host
+
+
+def get_video_links(status):
+    """
+    The links of a status which may lead to a video: (links to a video
+    host, short links to resolve to know)
+    """
+    entities = status.get('entities', {})
+    if 'urls' in entities:
+        links = [url.get('expanded_url') or url['url']
+                 for url in entities['urls']]
+    else:
+        links = get_text_links(status)
+
+    videos = []
+    to_resolve = []
+    for link in links:
+        host = get_host(link)
+        if host in VIDEO_HOSTS:
+            videos.append(link)
+        elif host in SHORTENERS:
+            to_resolve.append(link)
+    return videos, to_resolve
+
+
+def classify_status(status):
+    """
+    The kinds of medias (IMAGE, VIDEO) a status may hold, from its entities
+    only: IMAGE when it has media entities, VIDEO when one of its links
+    goes, or may go, to a video host.
+    """
+    kinds = set()
+    if get_images_from_status(status):
+        kinds.add(IMAGE)
+
+    videos, to_resolve = get_video_links(status)
+    if videos or to_resolve:
+        kinds.add(VIDEO)
+    return kinds
+
+
+## iteration helpers
+def chunks(array, size):
+    """ split array in lists of `size` elements """
+    return [array[i:i + size] for i in range(0, len(array), size)]
+
+
+def background(iterable, size, stopped=None):
+    """
+    Iterate over `iterable` in a producer thread, at most `size` items ahead
+    of the consumer. Exceptions raised by the producer are raised again in
+    the consumer when it reaches them, so items keep their order.
+    The consumer gives up waiting for the producer (the iteration ends) as
+    soon as `stopped()` is True, a stalled producer can't hold it.
+    """
+    queue = Queue.Queue(max(size, 1))
+    stop = threading.Event()
+
+    def put(item):
+        """ put in the queue unless the consumer went away """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        """ producer thread """
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception:
+            put((False, sys.exc_info()))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            try:
+                # with a timeout, the signals are handled while we wait
+                is_item, item = queue.get(timeout=1)
+            except Queue.Empty:
+                if stopped is not None and stopped():
+                    return
+                continue
+            if is_item:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        stop.set()
@@ -21,8 +21,18 @@ setup(
     packages=['download_twitter'],
     scripts=[
         'bin/all_tweets.py',
+        'bin/convert_tweets.py',
+        'bin/coordinator.py',
+        'bin/daemon.py',
+        'bin/dedupe.py',
         'bin/download_image.py',
+        'bin/media_index.py',
+        'bin/migrate_store.py',
+        'bin/rebuild_index.py',
         'bin/refresh_lists.py',
+        'bin/scan_images.py',
+        'bin/simulate_polling.py',
+        'bin/worker.py',
     ],
     install_requires=[
         'pexif>=0.13',